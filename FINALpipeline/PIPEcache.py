@@ -0,0 +1,118 @@
+import os
+import json
+import time
+import pickle
+import sqlite3
+import hashlib
+import threading
+import PIPEmetrics
+
+class VisionCache:
+    """Persistent cache of per-image stage results, keyed by image content
+
+    Entries are keyed by the SHA-1 of the image file, the stage name and the
+    stage parameters (which should include a version that is bumped whenever
+    the stage's output changes). Results live in a SQLite database so several
+    worker processes can share one cache; the least recently used entries are
+    evicted once the stored results exceed max_bytes.
+    """
+
+    def __init__(self, path='./.cache/vision_cache.sqlite', max_bytes=512 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._hashes = {}
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def __getstate__(self):
+        # Connections are per process and thread; a copy opens its own
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _connection(self):
+        # SQLite connections must not cross a fork or a thread, so open one per process and thread
+        local = self._local
+        if getattr(local, 'conn', None) is None or local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''CREATE TABLE IF NOT EXISTS results (
+                                key TEXT PRIMARY KEY,
+                                value BLOB NOT NULL,
+                                size INTEGER NOT NULL,
+                                last_access REAL NOT NULL)''')
+            conn.execute('CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)')
+            conn.commit()
+            local.conn = conn
+            local.pid = os.getpid()
+        return local.conn
+
+    def image_hash(self, image_path):
+        """SHA-1 of the image file, remembered per path, size and mtime"""
+        stat = os.stat(image_path)
+        memo_key = (os.path.abspath(image_path), stat.st_size, stat.st_mtime_ns)
+        if memo_key not in self._hashes:
+            digest = hashlib.sha1()
+            with open(image_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+            self._hashes[memo_key] = digest.hexdigest()
+        return self._hashes[memo_key]
+
+    def _key(self, image_hash, stage, params):
+        return f"{image_hash}:{stage}:{json.dumps(params, sort_keys=True)}"
+
+    def get(self, image_hash, stage, params):
+        """Return the cached result, or None when there is none"""
+        conn = self._connection()
+        key = self._key(image_hash, stage, params)
+        row = conn.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        with conn:
+            conn.execute('UPDATE results SET last_access = ? WHERE key = ?', (time.time(), key))
+        return pickle.loads(row[0])
+
+    def put(self, image_hash, stage, params, value):
+        conn = self._connection()
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO results (key, value, size, last_access) VALUES (?, ?, ?, ?)',
+                         (self._key(image_hash, stage, params), blob, len(blob), time.time()))
+            self._evict(conn)
+
+    def get_or_compute(self, image_path, stage, params, compute, image_hash=None):
+        """Return the cached result for this image and stage, computing it on a miss"""
+        if image_hash is None:
+            image_hash = self.image_hash(image_path)
+        value = self.get(image_hash, stage, params)
+        if value is None:
+            PIPEmetrics.count('cache.misses')
+            value = compute()
+            self.put(image_hash, stage, params, value)
+        else:
+            PIPEmetrics.count('cache.hits')
+        return value
+
+    def _evict(self, conn):
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Drop least recently used entries until the cache fits again
+        rows = conn.execute('SELECT key, size FROM results ORDER BY last_access').fetchall()
+        stale = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            stale.append((key,))
+            total -= size
+        conn.executemany('DELETE FROM results WHERE key = ?', stale)
+
+    def clear(self):
+        conn = self._connection()
+        with conn:
+            conn.execute('DELETE FROM results')
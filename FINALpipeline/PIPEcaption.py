@@ -0,0 +1,116 @@
+import re
+import threading
+
+class CaptionDoc:
+    """A caption normalized once, plus the known labels found in it"""
+
+    def __init__(self, text, lemma_text=None):
+        self.text = text.lower()
+        self.lemma_text = lemma_text
+        self.found = set()
+        self.matcher_version = -1
+
+
+class CaptionAnalyzer:
+    """Matches detected labels against captions with one precompiled pattern
+
+    All known label phrases (and their synonyms) are compiled into a single
+    regular expression that is run once over the caption. Every label found is
+    recorded, including labels that only occur inside a longer match, so the
+    result is the same as testing each label with a substring check. Labels
+    that were never registered fall back to that substring check.
+
+    With use_lemmas=True the caption is also lemmatized by spaCy (parser and
+    NER disabled) and labels are matched against the lemmas as well, so that
+    e.g. "peacocks" or "people" can match "peacock" or a "person" synonym.
+    """
+
+    def __init__(self, labels=(), synonyms=None, use_lemmas=False, model="en_core_web_sm"):
+        self.synonyms = {label.lower(): [s.lower() for s in phrases] for label, phrases in (synonyms or {}).items()}
+        self.use_lemmas = use_lemmas
+        self.nlp = None
+        if use_lemmas:
+            import spacy
+            self.nlp = spacy.load(model, disable=["parser", "ner"])
+
+        self.labels = set()
+        self._lock = threading.Lock()
+        self.version = 0
+        self.pattern = None
+        self.phrase_labels = {}
+        self.add_labels(labels)
+
+    def add_labels(self, labels):
+        """Register more labels, recompiling the matcher only if something is new"""
+        new_labels = {label.lower() for label in labels if label} - self.labels
+        if not new_labels:
+            return
+        with self._lock:
+            self._add_labels(new_labels)
+
+    def _add_labels(self, new_labels):
+        self.labels = self.labels | new_labels
+
+        # Each phrase maps to the labels it stands for
+        phrase_labels = {}
+        for label in self.labels:
+            for phrase in [label] + self.synonyms.get(label, []):
+                phrase_labels.setdefault(phrase, set()).add(label)
+
+        # A match of a phrase also implies every phrase contained in it; with the
+        # alternatives ordered longest first this recovers overlapping matches
+        phrases = sorted(phrase_labels, key=len, reverse=True)
+        # Labels only grow and the map is published before the pattern, so a
+        # reader taking the pattern first always finds its phrases in the map
+        self.phrase_labels = {
+            phrase: set().union(*(phrase_labels[other] for other in phrases if other in phrase))
+            for phrase in phrases
+        }
+        self.pattern = re.compile("(?=(" + "|".join(re.escape(p) for p in phrases) + "))")
+        self.version += 1
+
+    def _make_doc(self, caption, spacy_doc=None):
+        lemma_text = None
+        if spacy_doc is not None:
+            lemma_text = " ".join(token.lemma_.lower() for token in spacy_doc)
+        return CaptionDoc(caption, lemma_text)
+
+    def analyze(self, caption):
+        """Normalize a single caption"""
+        spacy_doc = self.nlp(caption) if self.nlp is not None else None
+        return self._make_doc(caption, spacy_doc)
+
+    def analyze_many(self, captions, batch_size=64):
+        """Normalize many captions, batching them through spaCy when lemmas are used"""
+        if self.nlp is None:
+            return [self._make_doc(caption) for caption in captions]
+        captions = list(captions)
+        return [self._make_doc(caption, spacy_doc)
+                for caption, spacy_doc in zip(captions, self.nlp.pipe(captions, batch_size=batch_size))]
+
+    def _update_found(self, doc):
+        if doc.matcher_version == self.version:
+            return
+        version = self.version
+        pattern = self.pattern
+        phrase_labels = self.phrase_labels
+        found = set()
+        if pattern is not None:
+            for text in (doc.text, doc.lemma_text):
+                if text:
+                    for match in pattern.finditer(text):
+                        found |= phrase_labels[match.group(1)]
+        doc.found = found
+        doc.matcher_version = version
+
+    def matches(self, doc, items):
+        """True if any of the detected items is mentioned in the caption"""
+        self._update_found(doc)
+        for item in items:
+            key = item.lower()
+            if key in self.labels:
+                if key in doc.found:
+                    return True
+            elif key in doc.text or (doc.lemma_text and key in doc.lemma_text):
+                return True
+        return False
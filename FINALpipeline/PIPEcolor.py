@@ -1,7 +1,12 @@
 import cv2
 import numpy as np
-import matplotlib.pyplot as plt
-from sklearn.cluster import DBSCAN
+from concurrent.futures import ThreadPoolExecutor
+import os
+import logging
+import PIPEmetrics
+from PIPEimage import ImageContext
+
+log = logging.getLogger(__name__)
 
 class IndianColorDetector:
 
@@ -22,12 +27,19 @@ class IndianColorDetector:
             'Peacock Blue': (51, 161, 201),
             'Gold': (255, 215, 0)
         }
-        
+
+        # Palette converted to LAB once so pixels can be matched in bulk
+        self.color_names = list(self.indian_colors.keys())
+        palette_rgb = np.uint8([list(self.indian_colors.values())])
+        self.palette_lab = cv2.cvtColor(palette_rgb, cv2.COLOR_RGB2LAB)[0]
+
+        # Thresholds a color has to meet in run_analysis to be reported
+        self.min_confidence = 0.035
+        self.min_count = 46500
+
     def preprocess_image(self, image):
         """Preprocess image with multiple techniques for better color detection"""
-        image_f = np.float32(image)
-        denoised = cv2.bilateralFilter(image_f, 9, 75, 75)
-        lab = cv2.cvtColor(image.astype(np.uint8), cv2.COLOR_RGB2LAB)
+        lab = cv2.cvtColor(image.astype(np.uint8, copy=False), cv2.COLOR_RGB2LAB)
         l, a, b = cv2.split(lab)
         clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8,8))
         cl = clahe.apply(l)
@@ -41,41 +53,84 @@ class IndianColorDetector:
         color2_lab = cv2.cvtColor(np.uint8([[color2]]), cv2.COLOR_RGB2LAB)[0][0]
         return np.sqrt(np.sum((color1_lab - color2_lab) ** 2))
 
-    def detect_colors_multiscale(self, image_path, scales=[1.0, 0.75, 0.5], tolerance=25):
-        """Detect Indian colors at multiple scales"""
-        original_image = cv2.imread(image_path)
-        image_rgb = cv2.cvtColor(original_image, cv2.COLOR_BGR2RGB)
-        
+    def detect_colors_multiscale(self, image_path, scales=[1.0, 0.75, 0.5], tolerance=25,
+                                 pyramid=False, early_stop=False):
+        """Detect Indian colors at multiple scales
+
+        image_path is a file path or a shared ImageContext.
+
+        With pyramid=True the image is preprocessed once at the largest scale and
+        each smaller scale is downsampled from the previous level instead of from
+        the original. With early_stop=True scales are visited largest first and
+        the search stops at the first scale where a color meets the run_analysis
+        thresholds; smaller scales only ever see fewer pixels, so they rarely add
+        anything once a larger scale has qualified.
+        """
+        if isinstance(image_path, ImageContext):
+            image_rgb = image_path.rgb
+        else:
+            original_image = cv2.imread(image_path)
+            image_rgb = cv2.cvtColor(original_image, cv2.COLOR_BGR2RGB)
+        min_count = self.count_threshold(image_path)
+        full_height, full_width = image_rgb.shape[:2]
+
+        if pyramid or early_stop:
+            scales = sorted(scales, reverse=True)
+
         results = []
+        level = None
         for scale in scales:
-            width = int(image_rgb.shape[1] * scale)
-            height = int(image_rgb.shape[0] * scale)
-            scaled_image = cv2.resize(image_rgb, (width, height))
-            processed_image = self.preprocess_image(scaled_image)
-            scale_results = self.process_image_colors(processed_image, tolerance)
+            width = int(full_width * scale)
+            height = int(full_height * scale)
+            with PIPEmetrics.span('color.preprocess'):
+                if not pyramid:
+                    scaled_image = cv2.resize(image_rgb, (width, height))
+                    processed_image = self.preprocess_image(scaled_image)
+                elif level is None:
+                    if (width, height) == (full_width, full_height):
+                        level = self.preprocess_image(image_rgb)
+                    else:
+                        level = self.preprocess_image(cv2.resize(image_rgb, (width, height)))
+                    processed_image = level
+                else:
+                    # Derive this level from the previous (already enhanced) one
+                    level = cv2.resize(level, (width, height), interpolation=cv2.INTER_AREA)
+                    processed_image = level
+            with PIPEmetrics.span('color.match'):
+                scale_results = self.process_image_colors(processed_image, tolerance)
             results.append((scale, scale_results))
-            
+
+            if early_stop and self.filter_colors(scale_results, image_rgb.shape, min_count):
+                break
+
         return results, image_rgb
 
     def process_image_colors(self, image, tolerance):
         """Process image to detect Indian colors and their locations"""
         height, width = image.shape[:2]
-        detected_colors = {}
-        
-        image_lab = cv2.cvtColor(image, cv2.COLOR_RGB2LAB)
-        
+
         grid_size = 5
         y_coords = np.linspace(0, height-1, num=height//grid_size, dtype=int)
         x_coords = np.linspace(0, width-1, num=width//grid_size, dtype=int)
-        
-        for y in y_coords:
-            for x in x_coords:
-                pixel_color = image[y, x]
-                
-                for color_name, color_value in self.indian_colors.items():
-                    if self.color_distance(pixel_color, color_value) < tolerance:
-                        detected_colors[color_name] = detected_colors.get(color_name, 0) + 1
-        
+
+        # Convert only the sampled grid to LAB, one row per sampled pixel
+        sampled = np.ascontiguousarray(image[np.ix_(y_coords, x_coords)])
+        if sampled.size == 0:
+            return {}
+        PIPEmetrics.count('color.sampled_pixels', sampled.shape[0] * sampled.shape[1])
+        sampled_lab = cv2.cvtColor(sampled, cv2.COLOR_RGB2LAB).reshape(-1, 1, 3)
+
+        # Distance to every palette entry at once. The arithmetic stays in uint8
+        # like color_distance so counts (and the thresholds tuned on them) match.
+        diff = sampled_lab - self.palette_lab[np.newaxis, :, :]
+        dist_sq = (diff * diff).sum(axis=2, dtype=np.int64)
+        matches = np.count_nonzero(dist_sq < tolerance ** 2, axis=0)
+
+        detected_colors = {}
+        for color_name, count in zip(self.color_names, matches):
+            if count > 0:
+                detected_colors[color_name] = int(count)
+
         return detected_colors
 
     def analyze_color_distribution(self, detected_colors, image_shape):
@@ -95,8 +150,25 @@ class IndianColorDetector:
         
         return analysis
 
+    def count_threshold(self, image):
+        """min_count scaled down for images decoded below their file resolution"""
+        if isinstance(image, ImageContext):
+            return self.min_count * image.area_ratio
+        return self.min_count
+
+    def filter_colors(self, detected_colors, image_shape, min_count=None):
+        """Keep only the colors meeting the confidence and count thresholds"""
+        if min_count is None:
+            min_count = self.min_count
+        analysis = self.analyze_color_distribution(detected_colors, image_shape)
+        return {
+            color_name: stats for color_name, stats in analysis.items()
+            if stats['confidence'] >= self.min_confidence and stats['count'] >= min_count
+        }
+
     def visualize_results(self, image, detected_colors):
         """Visualize detected colors on the image"""
+        import matplotlib.pyplot as plt
         vis_image = image.copy()
         
         fig, ax = plt.subplots(figsize=(10, 5))
@@ -115,31 +187,108 @@ class IndianColorDetector:
         
         plt.tight_layout()
         # plt.show()
+        plt.close(fig)
+
+    def run_analysis(self, image_path, pyramid=False, early_stop=False, headless=False):
+        """Run complete color analysis
 
-    def run_analysis(self, image_path):
-        """Run complete color analysis"""
-        results, original_image = self.detect_colors_multiscale(image_path)
+        image_path may also be a shared ImageContext. headless=True skips all
+        logging and plotting; use ColorReportWriter with the stored
+        last_analysis to render reports afterwards if needed.
+        """
+        results, original_image = self.detect_colors_multiscale(
+            image_path, pyramid=pyramid, early_stop=early_stop)
+        min_count = self.count_threshold(image_path)
         
         filtered_colors = {}
         for scale, detected_colors in results:
-            print(f"\nResults for scale {scale}:")
+            if headless:
+                filtered_colors.update(self.filter_colors(detected_colors, original_image.shape, min_count))
+                continue
+
+            log.info("Results for scale %s:", scale)
             analysis = self.analyze_color_distribution(detected_colors, original_image.shape)
             
             for color_name, stats in analysis.items():
-                print(f"\n{color_name}:")
-                print(f"  Pixels detected: {stats['count']}")
-                print(f"  Coverage: {stats['percentage']:.2f}%")
-                print(f"  Confidence: {stats['confidence']:.2f}")
+                log.info("%s: pixels detected %d, coverage %.2f%%, confidence %.2f",
+                         color_name, stats['count'], stats['percentage'], stats['confidence'])
                 
                 # Filter based on confidence and coverage criteria
-                if stats['confidence']>=0.035 and stats['count']>=46500:  # stats['percentage'] > 0.015 and   # Updated coverage threshold
+                if stats['confidence']>=self.min_confidence and stats['count']>=min_count:  # stats['percentage'] > 0.015 and   # Updated coverage threshold
                     filtered_colors[color_name] = stats
             
             # Visualize results for the filtered colors only
             self.visualize_results(original_image, filtered_colors)
 
+        # Keep the raw results around so reports can be rendered later
+        self.last_analysis = {
+            'image_path': image_path.path if isinstance(image_path, ImageContext) else image_path,
+            'scales': results,
+            'filtered_colors': filtered_colors
+        }
+
         return list(filtered_colors.keys())  # Return a unique list of detected colors
 
+
+class ColorReportWriter:
+    """Renders color detection overlays to image files, optionally in the background"""
+
+    def __init__(self, detector, output_dir, asynchronous=False, max_points=2000):
+        self.detector = detector
+        self.output_dir = output_dir
+        self.max_points = max_points
+        self.executor = ThreadPoolExecutor(max_workers=1) if asynchronous else None
+        os.makedirs(output_dir, exist_ok=True)
+
+    def render(self, image_path, filtered_colors, output_path):
+        """Draw the filtered colors over the image and save it to output_path"""
+        from matplotlib.figure import Figure
+        image = cv2.cvtColor(cv2.imread(image_path), cv2.COLOR_BGR2RGB)
+        rng = np.random.default_rng(0)
+
+        # Figure is used directly (not pyplot) so nothing is left registered
+        # with the pyplot state machine once the file is written
+        fig = Figure(figsize=(10, 5))
+        ax = fig.subplots()
+        ax.imshow(image)
+
+        for color_name, stats in filtered_colors.items():
+            points = min(stats['count'], self.max_points)
+            if points > 0:
+                color_rgb = np.array(self.detector.indian_colors[color_name]) / 255.0
+                ax.scatter(rng.integers(0, image.shape[1], points),
+                           rng.integers(0, image.shape[0], points),
+                           c=[color_rgb], label=f"{color_name} ({stats['percentage']:.2f}%)",
+                           alpha=0.6, s=20)
+
+        ax.set_title('Detected Indian Colors')
+        if filtered_colors:
+            ax.legend(bbox_to_anchor=(1.05, 1), loc='upper left')
+        ax.axis('off')
+        fig.tight_layout()
+        fig.savefig(output_path)
+        fig.clear()
+        return output_path
+
+    def submit(self, analysis, name=None):
+        """Render a report for a stored run_analysis result
+
+        Returns the output path, or a Future resolving to it in asynchronous mode.
+        """
+        image_path = analysis['image_path']
+        if name is None:
+            name = os.path.splitext(os.path.basename(image_path))[0] + '_colors.png'
+        output_path = os.path.join(self.output_dir, name)
+
+        if self.executor is None:
+            return self.render(image_path, analysis['filtered_colors'], output_path)
+        return self.executor.submit(self.render, image_path, analysis['filtered_colors'], output_path)
+
+    def close(self):
+        """Wait for pending reports to finish"""
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
 # Example usage
 def main():
     detector = IndianColorDetector()
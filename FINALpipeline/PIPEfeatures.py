@@ -0,0 +1,403 @@
+import os
+import re
+import json
+import argparse
+import itertools
+import numpy as np
+from PIPEcaption import CaptionAnalyzer
+
+# Reference files scored by Qwen, relative to FINALpipeline
+QWEN_FILES = [
+    "../tester/res_with_qwen_res.jsonl",
+    "../tester/res_with_qwen_res_with_explanation.jsonl",
+    "../tester/res_with_qwen_res_with_explanation_nitin.jsonl"
+]
+
+# Columns of the feature store, one row per image-caption pair. Ragged evidence is stored as JSON text.
+COLUMNS = ['image_path', 'caption', 'qwen', 'objects', 'symbols', 'colors', 'ocr_text', 'pixels', 'area_ratio']
+
+# The configuration main.main scores with today (see WEIGHTS in main.py and the stage thresholds)
+CURRENT_CONFIG = {
+    'weights': (0.30, 0.4, 0.20, 0.1),
+    'object_confidence': 0.25,
+    'symbol_threshold': 0.5,
+    'color_confidence': 0.035,
+    'color_count': 46500
+}
+
+COMPONENTS = ('objects', 'symbols', 'color', 'ocr')
+
+SCORE_PATTERN = re.compile(r'score\s*(?:of|is|:)?\s*(\d+(?:\.\d+)?)', re.IGNORECASE)
+
+
+def parse_qwen_score(qwen_res):
+    """Numeric score from a qwen_res entry: a bare number or free text with 'Score: N'"""
+    text = (qwen_res[0] if isinstance(qwen_res, list) and qwen_res else str(qwen_res)).strip()
+    try:
+        return float(text)
+    except ValueError:
+        match = SCORE_PATTERN.search(text)
+        return float(match.group(1)) if match else None
+
+
+def normalize_image_path(image_path):
+    """Reference files write '/Me/x.jpg' or 'indian_temples/x.jpg'; both become './...'"""
+    return os.path.join('.', image_path.lstrip('/'))
+
+
+def read_qwen_scores(qwen_files):
+    """Average Qwen score per (image_path, caption) over every file that scored the pair"""
+    scores = {}
+    unscored = 0
+    for qwen_file in qwen_files:
+        with open(qwen_file, "r") as f:
+            for line in f:
+                data = json.loads(line)
+                caption = data.get('caption', data.get('gemini_response'))
+                score = parse_qwen_score(data['qwen_res'])
+                if caption is None or score is None:
+                    unscored += 1
+                    continue
+                scores.setdefault((normalize_image_path(data['image_path']), caption), []).append(score)
+    if unscored:
+        print(f"Skipped {unscored} Qwen rows without a caption or a readable score")
+    return {pair: sum(values) / len(values) for pair, values in scores.items()}
+
+
+def image_evidence(image, detector, symbol_bank, color_detector, ocr_engine):
+    """Raw output of every stage for one ImageContext, before any threshold is applied"""
+    from PIPEsymbol_detection import symbol_scores
+
+    objects = [[detection['object'], float(detection['confidence'])]
+               for detection in detector.detect([image.bgr])[0]]
+
+    # Largest count of each color at any scale; a color passes the thresholds at some scale iff this count does
+    results, image_rgb = color_detector.detect_colors_multiscale(image)
+    colors = {}
+    for scale, detected_colors in results:
+        for color_name, count in detected_colors.items():
+            colors[color_name] = max(colors.get(color_name, 0), count)
+
+    return {
+        'objects': objects,
+        'symbols': symbol_scores(image, symbol_bank),
+        'colors': colors,
+        'ocr_text': ocr_engine.analyze(image)[0],
+        'pixels': image_rgb.shape[0] * image_rgb.shape[1],
+        'area_ratio': image.area_ratio
+    }
+
+
+def load_features(path):
+    with np.load(path) as store:
+        return {column: store[column] for column in COLUMNS}
+
+
+def extract_features(qwen_files, output_file, max_side=None, shard_dir=None):
+    """Run every stage once per image and store the raw evidence for every Qwen-scored pair
+
+    Pairs already in output_file are kept, so adding reference files only
+    processes the new pairs.
+    """
+    from PIPEimage import ImageContext
+    from PIPEobject_detection import get_detector
+    from PIPEsymbol_detection import SymbolTemplateBank
+    from PIPEcolor import IndianColorDetector
+    from PIPEocrAnalysis import get_engine
+    from PIPEshards import ShardStore
+
+    rows = {}
+    if os.path.exists(output_file):
+        existing = load_features(output_file)
+        for values in zip(*(existing[column] for column in COLUMNS)):
+            row = dict(zip(COLUMNS, values))
+            rows[(str(row['image_path']), str(row['caption']))] = row
+
+    qwen_scores = read_qwen_scores(qwen_files)
+    for pair, row in rows.items():
+        if pair in qwen_scores:
+            row['qwen'] = qwen_scores[pair]
+
+    missing = [pair for pair in qwen_scores if pair not in rows]
+    symbol_bank = SymbolTemplateBank("./symbols", cache_dir="./.cache")
+    color_detector = IndianColorDetector()
+    shard_store = ShardStore(shard_dir) if shard_dir else None
+
+    evidence = {}
+    unmatched = 0
+    for image_path, caption in missing:
+        if image_path not in evidence:
+            if shard_store is not None and image_path in shard_store:
+                image = shard_store.context(image_path)
+            else:
+                image = ImageContext(image_path, max_side)
+            try:
+                found = image_evidence(image, get_detector(), symbol_bank, color_detector, get_engine())
+            except Exception as e:
+                print(f"Error: Could not extract features for {image_path}: {e}")
+                found = None
+            evidence[image_path] = found
+        if evidence[image_path] is None:
+            unmatched += 1
+            continue
+
+        found = evidence[image_path]
+        rows[(image_path, caption)] = {
+            'image_path': image_path,
+            'caption': caption,
+            'qwen': qwen_scores[(image_path, caption)],
+            'objects': json.dumps(found['objects']),
+            'symbols': json.dumps(found['symbols']),
+            'colors': json.dumps(found['colors']),
+            'ocr_text': found['ocr_text'],
+            'pixels': found['pixels'],
+            'area_ratio': found['area_ratio']
+        }
+
+    if unmatched:
+        print(f"{unmatched} of {len(qwen_scores)} Qwen scored pairs have no features (image missing or unreadable)")
+
+    rows = list(rows.values())
+    columns = {
+        'image_path': np.array([row['image_path'] for row in rows], dtype=str),
+        'caption': np.array([row['caption'] for row in rows], dtype=str),
+        'qwen': np.array([row['qwen'] for row in rows], dtype=np.float64),
+        'objects': np.array([row['objects'] for row in rows], dtype=str),
+        'symbols': np.array([row['symbols'] for row in rows], dtype=str),
+        'colors': np.array([row['colors'] for row in rows], dtype=str),
+        'ocr_text': np.array([row['ocr_text'] for row in rows], dtype=str),
+        'pixels': np.array([row['pixels'] for row in rows], dtype=np.int64),
+        'area_ratio': np.array([row['area_ratio'] for row in rows], dtype=np.float64)
+    }
+    directory = os.path.dirname(output_file)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_file = output_file + ".tmp.npz"
+    np.savez_compressed(temp_file, **columns)
+    os.replace(temp_file, output_file)
+    print(f"Stored features for {len(rows)} pairs ({len(missing)} new) in {output_file}")
+    return columns
+
+
+def match_features(features, analyzer=None):
+    """Reduce the stored evidence to one number per pair and component
+
+    For each pair: the best confidence of a detected object that the caption
+    mentions, the best matching score of a mentioned symbol, the largest
+    count of a mentioned color and whether the OCR text occurs in the caption
+    (-1 where nothing is mentioned). Matching follows main.check_similarity.
+    """
+    objects = [json.loads(value) for value in features['objects']]
+    symbols = [json.loads(value) for value in features['symbols']]
+    colors = [json.loads(value) for value in features['colors']]
+
+    if analyzer is None:
+        analyzer = CaptionAnalyzer()
+    analyzer.add_labels({label for detections in objects for label, _ in detections})
+    analyzer.add_labels({name for scores in symbols for name in scores})
+    analyzer.add_labels({name for counts in colors for name in counts})
+
+    docs = analyzer.analyze_many(str(caption) for caption in features['caption'])
+    count = len(docs)
+    matched = {component: np.full(count, -1.0) for component in COMPONENTS}
+    for i, doc in enumerate(docs):
+        for label, confidence in objects[i]:
+            if analyzer.matches(doc, [label]):
+                matched['objects'][i] = max(matched['objects'][i], confidence)
+        for name, score in symbols[i].items():
+            if analyzer.matches(doc, [name]):
+                matched['symbols'][i] = max(matched['symbols'][i], score)
+        for name, color_count in colors[i].items():
+            if analyzer.matches(doc, [name]):
+                matched['color'][i] = max(matched['color'][i], color_count)
+        text = str(features['ocr_text'][i])
+        if text and analyzer.matches(doc, [text]):
+            matched['ocr'][i] = 1.0
+    return matched
+
+
+def weight_grid(step=0.05):
+    """Every combination of non-negative component weights in multiples of step that sums to 1"""
+    units = int(round(1 / step))
+    grid = [combination for combination in itertools.product(range(units + 1), repeat=len(COMPONENTS) - 1)
+            if sum(combination) <= units]
+    return np.array([list(combination) + [units - sum(combination)] for combination in grid]) / units
+
+
+def component_indicators(features, matched, object_confidences, symbol_thresholds, color_confidences, color_counts):
+    """0/1 score of every component for every threshold setting, one row per setting"""
+    pixels = features['pixels'].astype(np.float64)
+    area_ratio = features['area_ratio']
+    # A color passes when its count reaches both the scaled count and the confidence threshold
+    required = np.maximum(np.asarray(color_counts)[np.newaxis, :, np.newaxis] * area_ratio,
+                          np.asarray(color_confidences)[:, np.newaxis, np.newaxis] * pixels)
+    color = (matched['color'] >= required).reshape(-1, len(pixels))
+    color &= matched['color'] >= 0
+
+    return [
+        (matched['objects'] >= np.asarray(object_confidences)[:, np.newaxis]) & (matched['objects'] >= 0),
+        (matched['symbols'] >= np.asarray(symbol_thresholds)[:, np.newaxis]) & (matched['symbols'] >= 0),
+        color,
+        (matched['ocr'] > 0)[np.newaxis, :]
+    ]
+
+
+def sweep_correlations(indicators, weights, reference):
+    """Pearson correlation with reference of the weighted score of every configuration
+
+    The score is linear in the indicators, so its covariance with the
+    reference and its variance follow from the per-setting covariances of the
+    components; no per-configuration score vector is ever built. The result
+    has one axis for the weights and one per component's settings.
+    """
+    reference = reference - reference.mean()
+    centered = [indicator - indicator.mean(axis=1, keepdims=True) for indicator in indicators]
+    count = len(reference)
+    ndim = len(indicators) + 1
+
+    def expand(values, *axes):
+        shape = [1] * ndim
+        for axis, size in zip(axes, values.shape):
+            shape[axis + 1] = size
+        return values.reshape(shape)
+
+    def weight(k):
+        return weights[:, k].reshape((-1,) + (1,) * len(indicators))
+
+    covariance = 0
+    variance = 0
+    for k, component in enumerate(centered):
+        covariance = covariance + weight(k) * expand(component @ reference / count, k)
+        variance = variance + weight(k) ** 2 * expand((component * component).mean(axis=1), k)
+        for l in range(k + 1, len(centered)):
+            cross = component @ centered[l].T / count
+            variance = variance + 2 * weight(k) * weight(l) * expand(cross, k, l)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return covariance / np.sqrt(variance * (reference * reference).mean())
+
+
+def _ranks(values):
+    # Average rank of tied values, as used by Spearman's correlation
+    order = np.argsort(values, kind='mergesort')
+    ranks = np.empty(len(values))
+    ranks[order] = np.arange(len(values))
+    _, inverse, counts = np.unique(values, return_inverse=True, return_counts=True)
+    sums = np.bincount(inverse, weights=ranks)
+    return sums[inverse] / counts[inverse]
+
+
+def evaluate(indicators, settings, weights, reference):
+    """Scores of one configuration and their Pearson, Spearman and mean absolute error against reference"""
+    components = np.stack([indicator[setting] for indicator, setting in zip(indicators, settings)])
+    scores = np.asarray(weights) @ components * 10
+    if scores.std() == 0:
+        pearson = spearman = float('nan')
+    else:
+        pearson = float(np.corrcoef(scores, reference)[0, 1])
+        spearman = float(np.corrcoef(_ranks(scores), _ranks(reference))[0, 1])
+    return {'pearson': pearson, 'spearman': spearman, 'mae': float(np.abs(scores - reference).mean())}
+
+
+def sweep(features, weight_step=0.05, object_confidences=None, symbol_thresholds=None,
+          color_confidences=None, color_counts=None, top=20, report_file=None):
+    """Rank every weight and threshold configuration by correlation with the Qwen scores"""
+    object_confidences = np.asarray(object_confidences or [0.25, 0.35, 0.45, 0.55, 0.65])
+    symbol_thresholds = np.asarray(symbol_thresholds or np.round(np.arange(0.3, 0.95, 0.05), 2).tolist())
+    color_confidences = np.asarray(color_confidences or [0.0, 0.01, 0.02, 0.035, 0.05, 0.075, 0.1])
+    color_counts = np.asarray(color_counts or [0, 10000, 25000, 46500, 75000, 100000])
+    weights = weight_grid(weight_step)
+
+    matched = match_features(features)
+    indicators = component_indicators(features, matched, object_confidences, symbol_thresholds,
+                                      color_confidences, color_counts)
+    reference = features['qwen']
+    correlations = sweep_correlations(indicators, weights, reference)
+
+    def describe(index):
+        w, o, s, c, _ = index
+        confidence, count = divmod(c, len(color_counts))
+        return {
+            'weights': tuple(float(value) for value in weights[w]),
+            'object_confidence': float(object_confidences[o]),
+            'symbol_threshold': float(symbol_thresholds[s]),
+            'color_confidence': float(color_confidences[confidence]),
+            'color_count': int(color_counts[count])
+        }
+
+    # NaN (constant score) configurations sort last
+    flat = np.where(np.isnan(correlations), -np.inf, correlations).ravel()
+    order = np.argsort(-flat, kind='stable')
+    print(f"Swept {flat.size} configurations over {len(reference)} pairs")
+
+    ranking = []
+    for position in order[:top]:
+        index = np.unravel_index(position, correlations.shape)
+        config = describe(index)
+        config.update(evaluate(indicators, index[1:], weights[index[0]], reference))
+        ranking.append(config)
+
+    current = dict(CURRENT_CONFIG)
+    current_indicators = component_indicators(features, matched, [current['object_confidence']],
+                                              [current['symbol_threshold']], [current['color_confidence']],
+                                              [current['color_count']])
+    current.update(evaluate(current_indicators, (0, 0, 0, 0), current['weights'], reference))
+
+    if report_file:
+        index = np.unravel_index(order, correlations.shape)
+        confidence, count = np.divmod(index[3], len(color_counts))
+        table = np.column_stack([correlations.ravel()[order], weights[index[0]], object_confidences[index[1]],
+                                 symbol_thresholds[index[2]], color_confidences[confidence], color_counts[count]])
+        np.savetxt(report_file, table, fmt='%.6g', delimiter=',', comments='',
+                   header="pearson,w_objects,w_symbols,w_color,w_ocr,object_confidence,symbol_threshold,"
+                          "color_confidence,color_count")
+        print(f"Wrote all configurations to {report_file}")
+
+    return ranking, current
+
+
+def _print_config(config):
+    weights = ", ".join(f"{name} {value:.2f}" for name, value in zip(COMPONENTS, config['weights']))
+    print(f"  pearson {config['pearson']:.3f}  spearman {config['spearman']:.3f}  mae {config['mae']:.2f}  |  "
+          f"weights {weights}  object conf {config['object_confidence']}  symbol thr {config['symbol_threshold']}  "
+          f"color conf {config['color_confidence']}  color count {config['color_count']}")
+
+
+def _floats(text):
+    return [float(value) for value in text.split(",")] if text else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Store per-stage evidence once and tune weights and thresholds "
+                                                 "against the Qwen reference scores")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    extract = commands.add_parser("extract", help="run the vision stages and store their raw evidence")
+    extract.add_argument("inputs", nargs="*", default=QWEN_FILES, help="Qwen-scored JSONL files")
+    extract.add_argument("--output", default="./.cache/features.npz", help="feature store file")
+    extract.add_argument("--max-side", type=int, default=None, help="cap on the decoded image size")
+    extract.add_argument("--shards", default=None, help="read images from shards packed by PIPEshards.py")
+
+    tune = commands.add_parser("sweep", help="score weight and threshold combinations from the feature store")
+    tune.add_argument("--features", default="./.cache/features.npz", help="feature store file")
+    tune.add_argument("--weight-step", type=float, default=0.05, help="granularity of the weight grid")
+    tune.add_argument("--object-confidences", default=None, help="comma separated values to try")
+    tune.add_argument("--symbol-thresholds", default=None, help="comma separated values to try")
+    tune.add_argument("--color-confidences", default=None, help="comma separated values to try")
+    tune.add_argument("--color-counts", default=None, help="comma separated values to try")
+    tune.add_argument("--top", type=int, default=20, help="number of best configurations to print")
+    tune.add_argument("--report", default=None, help="CSV file to write every configuration's correlation to")
+    args = parser.parse_args()
+
+    if args.command == "extract":
+        extract_features(args.inputs, args.output, args.max_side, args.shards)
+    else:
+        ranking, current = sweep(load_features(args.features), args.weight_step,
+                                 _floats(args.object_confidences), _floats(args.symbol_thresholds),
+                                 _floats(args.color_confidences), _floats(args.color_counts),
+                                 args.top, args.report)
+        print("Current configuration:")
+        _print_config(current)
+        print(f"Best {len(ranking)} configurations:")
+        for config in ranking:
+            _print_config(config)
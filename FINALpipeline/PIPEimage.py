@@ -0,0 +1,121 @@
+import cv2
+import numpy as np
+import threading
+from PIL import Image
+import PIPEmetrics
+
+# JPEG can be decoded straight to 1/2, 1/4 or 1/8 size via DCT scaling
+REDUCED_COLOR_FLAGS = {
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8
+}
+
+def _read_only(array):
+    array.setflags(write=False)
+    return array
+
+
+class ImageContext:
+    """An image decoded once and shared read-only by every pipeline stage
+
+    Decoding happens on first access, so a run that never needs the pixels
+    (e.g. every stage is cached) never opens the file. With max_side set the
+    image is decoded at reduced size: JPEGs use DCT scaling to the smallest
+    1/2, 1/4 or 1/8 size that still covers max_side, then any remaining excess
+    is resized away. All views (BGR, RGB, gray, scaled copies) are cached and
+    marked read-only; stages must copy before drawing on them.
+    """
+
+    def __init__(self, path, max_side=None):
+        self.path = path
+        self.max_side = max_side
+        self.original_size = None  # (width, height) of the file
+        self.content_hash = None  # SHA-1 of the file, when already known
+        self._views = {}
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_array(cls, bgr, path=None):
+        """Wrap an already decoded BGR image"""
+        context = cls(path)
+        context.original_size = (bgr.shape[1], bgr.shape[0])
+        context._views['bgr'] = _read_only(bgr)
+        return context
+
+    def _decode(self):
+        with Image.open(self.path) as image:
+            width, height = image.size
+        self.original_size = (width, height)
+
+        reduction = 1
+        if self.max_side is not None:
+            for factor in (8, 4, 2):
+                if max(width, height) / factor >= self.max_side:
+                    reduction = factor
+                    break
+
+        bgr = cv2.imread(self.path, REDUCED_COLOR_FLAGS.get(reduction, cv2.IMREAD_COLOR))
+        if bgr is None:
+            # OpenCV cannot read every format in the dataset (e.g. GIF), PIL can
+            with Image.open(self.path) as image:
+                bgr = cv2.cvtColor(np.asarray(image.convert('RGB')), cv2.COLOR_RGB2BGR)
+
+        if self.max_side is not None and max(bgr.shape[:2]) > self.max_side:
+            scale = self.max_side / max(bgr.shape[:2])
+            bgr = cv2.resize(bgr, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        return bgr
+
+    def _view(self, name, make):
+        view = self._views.get(name)
+        if view is None:
+            with self._lock:
+                view = self._views.get(name)
+                if view is None:
+                    view = _read_only(make())
+                    self._views[name] = view
+        return view
+
+    def _timed_decode(self):
+        with PIPEmetrics.span('image.decode'):
+            return self._decode()
+
+    @property
+    def bgr(self):
+        return self._view('bgr', self._timed_decode)
+
+    @property
+    def rgb(self):
+        return self._view('rgb', lambda: cv2.cvtColor(self.bgr, cv2.COLOR_BGR2RGB))
+
+    @property
+    def gray(self):
+        return self._view('gray', lambda: cv2.cvtColor(self.bgr, cv2.COLOR_BGR2GRAY))
+
+    @property
+    def pil(self):
+        """RGB PIL image sharing the decoded pixels"""
+        return Image.fromarray(self.rgb)
+
+    @property
+    def area_ratio(self):
+        """Decoded pixel count relative to the pixel count of the file"""
+        height, width = self.bgr.shape[:2]
+        return (width * height) / (self.original_size[0] * self.original_size[1])
+
+    def scaled(self, kind, scale):
+        """A 'bgr', 'rgb' or 'gray' view resized by scale, cached per scale"""
+        source = getattr(self, kind)
+        if scale == 1.0:
+            return source
+        width = int(source.shape[1] * scale)
+        height = int(source.shape[0] * scale)
+        return self._view(f"{kind}@{scale}", lambda: cv2.resize(source, (width, height)))
+
+    def pyramid(self, kind, levels):
+        """Successively halved copies of a view, full size first"""
+        images = [getattr(self, kind)]
+        for level in range(1, levels):
+            previous = images[-1]
+            images.append(self._view(f"{kind}/pyr{level}", lambda: cv2.pyrDown(previous)))
+        return images
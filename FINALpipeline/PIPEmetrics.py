@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import atexit
+import threading
+
+# Instrumentation for the pipeline: timing spans and counters.
+#
+#     with PIPEmetrics.span('symbols.match'):
+#         ...
+#     PIPEmetrics.count('symbols.candidates', len(boxes))
+#
+# Disabled by default; span() then returns a shared no-op context manager and
+# count() returns immediately, so instrumented code costs next to nothing.
+# Enable with configure(path) or the PIPELINE_METRICS environment variable.
+# Paths ending in .prom get a Prometheus text file with per span totals,
+# rewritten on every flush; anything else gets one JSON line per finished span
+# plus the counter totals on flush.
+
+_enabled = False
+_exporter = None
+_lock = threading.Lock()
+_local = threading.local()
+
+# Aggregates since configure(): span name -> [count, total seconds, max seconds], counter name -> total
+_spans = {}
+_counters = {}
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ('name', 'labels', 'parent', 'start')
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.parent = stack[-1] if stack else None
+        stack.append(self.name)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        _local.stack.pop()
+        _record_span(self.name, seconds, self.parent, self.labels, exc_type is not None)
+        return False
+
+
+def enabled():
+    return _enabled
+
+
+def span(name, **labels):
+    """Time the enclosed block as span name; labels are kept in the JSON lines export"""
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, labels)
+
+
+def count(name, value=1):
+    """Add value to counter name"""
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def _record_span(name, seconds, parent, labels, failed):
+    with _lock:
+        totals = _spans.get(name)
+        if totals is None:
+            totals = _spans[name] = [0, 0.0, 0.0]
+        totals[0] += 1
+        totals[1] += seconds
+        totals[2] = max(totals[2], seconds)
+        if _exporter is not None:
+            _exporter.span(name, seconds, parent, labels, failed)
+
+
+def snapshot():
+    """Current span totals and counters"""
+    with _lock:
+        return {
+            'spans': {name: {'count': c, 'seconds': s, 'max_seconds': m} for name, (c, s, m) in _spans.items()},
+            'counters': dict(_counters)
+        }
+
+
+class JSONLinesExporter:
+    """Appends one JSON object per finished span, and the counters on flush"""
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'a', buffering=1 << 16)
+
+    def span(self, name, seconds, parent, labels, failed):
+        record = {'type': 'span', 'name': name, 'seconds': round(seconds, 6), 'pid': os.getpid(),
+                  'time': round(time.time(), 3)}
+        if parent is not None:
+            record['parent'] = parent
+        if labels:
+            record['labels'] = labels
+        if failed:
+            record['failed'] = True
+        self.f.write(json.dumps(record) + '\n')
+
+    def flush(self, totals):
+        self.f.write(json.dumps({'type': 'counters', 'pid': os.getpid(), 'time': round(time.time(), 3),
+                                 'counters': totals['counters']}) + '\n')
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class PrometheusExporter:
+    """Rewrites a Prometheus text file (e.g. for node_exporter's textfile collector) on every flush"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def span(self, name, seconds, parent, labels, failed):
+        pass
+
+    def flush(self, totals):
+        lines = [
+            '# HELP pipeline_span_seconds Time spent in each pipeline span.',
+            '# TYPE pipeline_span_seconds summary'
+        ]
+        for name, span_totals in sorted(totals['spans'].items()):
+            lines.append(f'pipeline_span_seconds_count{{span="{name}"}} {span_totals["count"]}')
+            lines.append(f'pipeline_span_seconds_sum{{span="{name}"}} {span_totals["seconds"]:.6f}')
+        lines.append('# HELP pipeline_span_max_seconds Longest single run of each pipeline span.')
+        lines.append('# TYPE pipeline_span_max_seconds gauge')
+        for name, span_totals in sorted(totals['spans'].items()):
+            lines.append(f'pipeline_span_max_seconds{{span="{name}"}} {span_totals["max_seconds"]:.6f}')
+        lines.append('# HELP pipeline_events_total Pipeline counters.')
+        lines.append('# TYPE pipeline_events_total counter')
+        for name, value in sorted(totals['counters'].items()):
+            lines.append(f'pipeline_events_total{{counter="{name}"}} {value}')
+
+        # Write then rename so a scraper never reads a half written file
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, self.path)
+
+    def close(self):
+        pass
+
+
+def configure(path=None, per_process=False):
+    """Enable instrumentation, exporting to path (see the module comment for formats)
+
+    With per_process=True the process id is added to the file name, so worker
+    processes do not write over or into each other's files. Without a path
+    the totals are only kept in memory (see snapshot()).
+    """
+    global _enabled, _exporter
+    disable()
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+        if path is not None and per_process:
+            stem, extension = os.path.splitext(path)
+            path = f"{stem}.{os.getpid()}{extension}"
+        if path is not None and path.endswith('.prom'):
+            _exporter = PrometheusExporter(path)
+        elif path is not None:
+            _exporter = JSONLinesExporter(path)
+        _enabled = True
+
+
+def flush():
+    """Export the counters (and, for Prometheus, the span totals) collected so far"""
+    if _exporter is None:
+        return
+    totals = snapshot()
+    with _lock:
+        if _exporter is not None:
+            _exporter.flush(totals)
+
+
+def disable():
+    """Flush and close the exporter and turn instrumentation off"""
+    global _enabled, _exporter
+    flush()
+    with _lock:
+        if _exporter is not None:
+            _exporter.close()
+        _exporter = None
+        _enabled = False
+
+
+atexit.register(disable)
+
+if os.environ.get('PIPELINE_METRICS'):
+    configure(os.environ['PIPELINE_METRICS'], per_process=True)
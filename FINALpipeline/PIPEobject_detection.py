@@ -1,32 +1,362 @@
-import torch
+import ast
+import os
+import hashlib
+import threading
+import importlib.util
 import cv2
 import numpy as np
+import PIPEmetrics
+from PIPEsymbol_detection import non_max_suppression, box_iou
 
-def detect_objects(image_path):
-    # Load pre-trained YOLOv5 model (fine-tune for Indian objects if available)
-    model = torch.hub.load('ultralytics/yolov5', 'yolov5s')  # YOLOv5 small model
+# Local YOLOv5 checkout and weights, so loading never touches the network.
+# The default checkout is where an earlier torch.hub.load('ultralytics/yolov5', 'yolov5s') left it.
+# Default model files live next to this module, whatever directory the pipeline runs from.
+MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+YOLOV5_REPO = os.environ.get('YOLOV5_REPO')
+YOLOV5_WEIGHTS = os.path.abspath(os.environ.get('YOLOV5_WEIGHTS', os.path.join(MODULE_DIR, 'yolov5s.pt')))
+# Made with YOLOv5's export.py: python export.py --weights yolov5s.pt --include onnx
+YOLOV5_ONNX = os.path.abspath(os.environ.get('YOLOV5_ONNX', os.path.join(MODULE_DIR, 'yolov5s.onnx')))
 
-    # Load the image
-    image = cv2.imread(image_path)
+# Detector backend: 'torch' runs the YOLOv5 checkpoint through PyTorch, 'onnx' runs an
+# exported (optionally INT8 quantized) model through ONNX Runtime without importing torch,
+# which starts much faster. ONNX is the default when its model and onnxruntime are there.
+OBJECT_BACKEND = os.environ.get('OBJECT_BACKEND') or (
+    'onnx' if os.path.exists(YOLOV5_ONNX) and importlib.util.find_spec('onnxruntime') else 'torch')
 
-    # Perform object detection
-    results = model(image)
+# Classes of the stock yolov5s weights (COCO), so callers can know the labels without loading
+# a model. Weights trained on other classes can list theirs, one per line, in a .names file
+# next to them (yolov5s-temples.pt -> yolov5s-temples.names)
+COCO_NAMES = [
+    'person', 'bicycle', 'car', 'motorcycle', 'airplane', 'bus', 'train', 'truck', 'boat', 'traffic light',
+    'fire hydrant', 'stop sign', 'parking meter', 'bench', 'bird', 'cat', 'dog', 'horse', 'sheep', 'cow',
+    'elephant', 'bear', 'zebra', 'giraffe', 'backpack', 'umbrella', 'handbag', 'tie', 'suitcase', 'frisbee',
+    'skis', 'snowboard', 'sports ball', 'kite', 'baseball bat', 'baseball glove', 'skateboard', 'surfboard',
+    'tennis racket', 'bottle', 'wine glass', 'cup', 'fork', 'knife', 'spoon', 'bowl', 'banana', 'apple',
+    'sandwich', 'orange', 'broccoli', 'carrot', 'hot dog', 'pizza', 'donut', 'cake', 'chair', 'couch',
+    'potted plant', 'bed', 'dining table', 'toilet', 'tv', 'laptop', 'mouse', 'remote', 'keyboard', 'cell phone',
+    'microwave', 'oven', 'toaster', 'sink', 'refrigerator', 'book', 'clock', 'vase', 'scissors', 'teddy bear',
+    'hair drier', 'toothbrush'
+]
 
-    # Extract information (coordinates, labels, confidence scores)
-    detections = results.xyxy[0].numpy()  # Format: [x_min, y_min, x_max, y_max, confidence, class]
+# Side of the square network input
+IMAGE_SIZE = 640
+
+# Thresholds used by YOLOv5's own inference wrapper
+CONF_THRESHOLD = 0.25
+IOU_THRESHOLD = 0.45
+MAX_DETECTIONS = 1000
+
+
+def letterbox(image, size=640, color=(114, 114, 114)):
+    """Resize image to fit a size x size square, keeping its aspect ratio, and pad the rest
+
+    Returns the padded image, the resize ratio and the (left, top) padding,
+    which scale_boxes uses to map boxes back onto the original image.
+    """
+    height, width = image.shape[:2]
+    ratio = min(size / height, size / width)
+    new_width, new_height = int(round(width * ratio)), int(round(height * ratio))
+    if (new_width, new_height) != (width, height):
+        image = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
+
+    pad_width, pad_height = (size - new_width) / 2, (size - new_height) / 2
+    top, bottom = int(round(pad_height - 0.1)), int(round(pad_height + 0.1))
+    left, right = int(round(pad_width - 0.1)), int(round(pad_width + 0.1))
+    image = cv2.copyMakeBorder(image, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)
+    return image, ratio, (left, top)
+
+
+def preprocess(images, size=640):
+    """Letterbox a batch of BGR images into one float32 RGB NCHW array scaled to 0-1"""
+    batch = np.empty((len(images), 3, size, size), dtype=np.float32)
+    transforms = []
+    for i, image in enumerate(images):
+        padded, ratio, padding = letterbox(image, size)
+        # BGR HWC -> RGB CHW
+        batch[i] = padded[..., ::-1].transpose(2, 0, 1)
+        transforms.append((ratio, padding))
+    batch /= 255.0
+    return batch, transforms
+
+
+def postprocess(prediction, conf_threshold=CONF_THRESHOLD, iou_threshold=IOU_THRESHOLD, max_detections=MAX_DETECTIONS):
+    """Raw YOLOv5 output of one image, (candidates, 5 + classes), to [x1, y1, x2, y2, conf, class] rows
+
+    Keeps candidates whose objectness times best class score passes
+    conf_threshold and runs per-class NMS on them.
+    """
+    prediction = prediction[prediction[:, 4] > conf_threshold]
+    if not len(prediction):
+        return np.zeros((0, 6), dtype=np.float32)
+
+    class_scores = prediction[:, 5:] * prediction[:, 4:5]
+    class_ids = class_scores.argmax(axis=1)
+    confidences = class_scores[np.arange(len(class_scores)), class_ids]
+    selected = confidences > conf_threshold
+    prediction, class_ids, confidences = prediction[selected], class_ids[selected], confidences[selected]
+
+    # Center x, center y, width, height -> corners
+    boxes = np.empty((len(prediction), 4), dtype=np.float32)
+    boxes[:, :2] = prediction[:, :2] - prediction[:, 2:4] / 2
+    boxes[:, 2:] = prediction[:, :2] + prediction[:, 2:4] / 2
+
+    PIPEmetrics.count('objects.candidates', len(boxes))
+    keep = non_max_suppression(boxes, confidences, iou_threshold, class_ids)[:max_detections]
+    return np.concatenate([boxes[keep], confidences[keep, None], class_ids[keep, None]], axis=1)
+
+
+def scale_boxes(detections, ratio, padding, shape):
+    """Map boxes from the letterboxed input back onto the original image of the given shape"""
+    detections = detections.copy()
+    detections[:, [0, 2]] = ((detections[:, [0, 2]] - padding[0]) / ratio).clip(0, shape[1])
+    detections[:, [1, 3]] = ((detections[:, [1, 3]] - padding[1]) / ratio).clip(0, shape[0])
+    return detections
+
+
+def _require(path, what, variable):
+    # Fail up front: YOLOv5 would otherwise try to download missing weights
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{what} not found at {path}, set {variable} to its location")
+
+
+def weights_key(path):
+    """Short identifier of a weights file: its absolute path, size and modification time"""
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    return hashlib.sha1(f"{path}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()[:16]
+
+
+class TorchBackend:
+    """YOLOv5 checkpoint run through PyTorch, without YOLOv5's own pre and post-processing"""
+
+    def __init__(self, weights=YOLOV5_WEIGHTS, repo_dir=YOLOV5_REPO, num_threads=None):
+        import torch
+        self.torch = torch
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        repo_dir = repo_dir or os.path.join(torch.hub.get_dir(), 'ultralytics_yolov5_master')
+        _require(repo_dir, "YOLOv5 checkout", 'YOLOV5_REPO')
+        _require(weights, "YOLOv5 weights", 'YOLOV5_WEIGHTS')
+
+        self.model = torch.hub.load(repo_dir, 'custom', path=weights, source='local', autoshape=False)
+        self.model.eval()
+        self.key = weights_key(weights)
+        names = self.model.names
+        self.names = list(names.values()) if isinstance(names, dict) else list(names)
+
+    def infer(self, batch):
+        with self.torch.inference_mode():
+            output = self.model(self.torch.from_numpy(batch))
+        if isinstance(output, (list, tuple)):
+            output = output[0]
+        return output.cpu().numpy()
+
+
+class ONNXBackend:
+    """YOLOv5 exported to ONNX (fp32 or INT8 quantized) run through ONNX Runtime on the CPU"""
+
+    def __init__(self, model_path=YOLOV5_ONNX, num_threads=None, names=None):
+        import onnxruntime
+        _require(model_path, "ONNX model", 'YOLOV5_ONNX')
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.key = weights_key(model_path)
+        self.input_name = self.session.get_inputs()[0].name
+
+        if names is None:
+            # YOLOv5's exporter stores the class names in the model metadata
+            metadata = self.session.get_modelmeta().custom_metadata_map
+            if 'names' not in metadata:
+                raise ValueError(f"{model_path} has no class names in its metadata, pass names explicitly")
+            names = ast.literal_eval(metadata['names'])
+        self.names = list(names.values()) if isinstance(names, dict) else list(names)
+
+    def infer(self, batch):
+        # Models exported with a fixed batch size of 1 are run image by image
+        if self.session.get_inputs()[0].shape[0] == 1 and len(batch) > 1:
+            return np.concatenate([self.infer(batch[i:i + 1]) for i in range(len(batch))])
+        return self.session.run(None, {self.input_name: batch})[0]
+
+
+BACKENDS = {
+    'torch': TorchBackend,
+    'onnx': ONNXBackend
+}
 
-    # Create a list to store the detection information
-    detection_list = []
 
-    # Loop through detections and store relevant info
-    for detection in detections:
-        x_min, y_min, x_max, y_max, confidence, class_id = detection
-        detection_info = {
-            'object': model.names[int(class_id)],
-            'coordinates': [x_min, y_min, x_max, y_max],
-            'confidence': confidence
-        }
-        detection_list.append(detection_info)
+class ObjectDetector:
+    """YOLOv5 detection on a pluggable backend, loaded once and reused for batches of images
+
+    The backend (see BACKENDS, default from OBJECT_BACKEND) only runs the
+    network; letterboxing, confidence filtering, NMS and mapping boxes back to
+    the image are shared, so every backend gives the same kind of results.
+    Extra keyword arguments go to the backend, e.g. model_path for 'onnx'.
+    """
+
+    def __init__(self, backend=None, num_threads=None, image_size=IMAGE_SIZE, **backend_options):
+        backend = backend or OBJECT_BACKEND
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown object detection backend: {backend}")
+        self.backend_name = backend
+        self.backend = BACKENDS[backend](num_threads=num_threads, **backend_options)
+        self.names = self.backend.names
+        self.image_size = image_size
+        # Identifies the model and input size, so cached detections are never shared between them
+        self.key = f"{backend}-{self.backend.key}-{image_size}"
+
+    def detect(self, images):
+        """Detect objects in a batch of BGR images with a single forward pass
+
+        Returns one list of detections per image, each detection a dict with
+        the object name, [x_min, y_min, x_max, y_max] coordinates and confidence.
+        """
+        with PIPEmetrics.span('objects.preprocess'):
+            batch, transforms = preprocess(images, self.image_size)
+
+        with PIPEmetrics.span('objects.inference', batch=len(images), backend=self.backend_name):
+            predictions = self.backend.infer(batch)
+
+        batch_detections = []
+        with PIPEmetrics.span('objects.postprocess'):
+            for image, prediction, (ratio, padding) in zip(images, predictions, transforms):
+                detections = scale_boxes(postprocess(prediction), ratio, padding, image.shape)
+                # Format: [x_min, y_min, x_max, y_max, confidence, class]
+                detection_list = []
+                for x_min, y_min, x_max, y_max, confidence, class_id in detections:
+                    detection_list.append({
+                        'object': self.names[int(class_id)],
+                        'coordinates': [x_min, y_min, x_max, y_max],
+                        'confidence': confidence
+                    })
+                batch_detections.append(detection_list)
+                PIPEmetrics.count('objects.detections', len(detection_list))
+
+        return batch_detections
+
+    def detect_paths(self, image_paths):
+        """Load the images at image_paths and detect objects in one batch"""
+        images = []
+        for image_path in image_paths:
+            image = cv2.imread(image_path)
+            if image is None:
+                raise FileNotFoundError(f"Image not found: {image_path}")
+            images.append(image)
+        return self.detect(images)
+
+
+# Bounds the ONNX backend has to stay within against PyTorch on the tester images
+PARITY_MIN_RECALL = 0.95
+PARITY_MAX_EXTRA = 0.05
+PARITY_CONFIDENCE_TOLERANCE = 0.05
+
+def check_backend_parity(image_paths, reference, candidate, iou_threshold=0.5,
+                         confidence_tolerance=PARITY_CONFIDENCE_TOLERANCE):
+    """Compare two detectors image by image
+
+    A reference detection counts as matched when the candidate has a detection
+    of the same object overlapping it by at least iou_threshold. Returns the
+    fraction of matched reference detections, the fraction of candidate
+    detections without a reference counterpart, and the largest confidence
+    difference over matched detections beyond confidence_tolerance.
+    """
+    matched = expected = extra = found = 0
+    worst_confidence = 0.0
+    for image_path in image_paths:
+        ref = reference.detect_paths([image_path])[0]
+        cand = candidate.detect_paths([image_path])[0]
+        used = set()
+        for detection in ref:
+            expected += 1
+            best, best_iou = None, iou_threshold
+            for j, other in enumerate(cand):
+                if j in used or other['object'] != detection['object']:
+                    continue
+                iou = box_iou(np.asarray(detection['coordinates'], dtype=np.float64),
+                              np.asarray([other['coordinates']], dtype=np.float64))[0]
+                if iou >= best_iou:
+                    best, best_iou = j, iou
+            if best is not None:
+                used.add(best)
+                matched += 1
+                difference = abs(float(detection['confidence']) - float(cand[best]['confidence']))
+                worst_confidence = max(worst_confidence, difference)
+        found += len(cand)
+        extra += len(cand) - len(used)
+    return {
+        'recall': matched / expected if expected else 1.0,
+        'extra': extra / found if found else 0.0,
+        'max_confidence_difference': worst_confidence,
+        'confidence_ok': worst_confidence <= confidence_tolerance
+    }
+
+
+def parity_failures(report, min_recall=PARITY_MIN_RECALL, max_extra=PARITY_MAX_EXTRA):
+    """Bounds a check_backend_parity report misses, as messages (empty when it passes)"""
+    failures = []
+    if report['recall'] < min_recall:
+        failures.append(f"recall {report['recall']:.3f} below {min_recall}")
+    if report['extra'] > max_extra:
+        failures.append(f"extra detections {report['extra']:.3f} above {max_extra}")
+    if not report['confidence_ok']:
+        failures.append(f"confidence differs by up to {report['max_confidence_difference']:.3f}")
+    return failures
+
+
+def quantize_onnx(model_path, output_path):
+    """Write an INT8 (dynamically quantized weights) copy of an ONNX model"""
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    quantize_dynamic(model_path, output_path, weight_type=QuantType.QUInt8)
+    return output_path
+
+
+# One detector per process, created on first use
+_detector = None
+_detector_lock = threading.Lock()
+
+def get_detector():
+    """Return this process's shared ObjectDetector, loading it on first use"""
+    global _detector
+    if _detector is None:
+        # Stage and service threads may all ask at once; only one of them loads the model
+        with _detector_lock:
+            if _detector is None:
+                _detector = ObjectDetector()
+    return _detector
+
+def detector_names():
+    """Class names of the detector get_detector() returns, without loading it if it is not loaded yet"""
+    if _detector is not None:
+        return list(_detector.names)
+    weights = YOLOV5_ONNX if OBJECT_BACKEND == 'onnx' else YOLOV5_WEIGHTS
+    names_path = os.path.splitext(weights)[0] + '.names'
+    if os.path.exists(names_path):
+        with open(names_path, encoding='utf-8') as f:
+            return [line.strip() for line in f if line.strip()]
+    return list(COCO_NAMES)
+
+def detector_key():
+    """Key of the detector get_detector() returns, without loading it if it is not loaded yet"""
+    if _detector is not None:
+        return _detector.key
+    weights, variable = (YOLOV5_ONNX, 'YOLOV5_ONNX') if OBJECT_BACKEND == 'onnx' else (YOLOV5_WEIGHTS, 'YOLOV5_WEIGHTS')
+    _require(weights, "Object detection model", variable)
+    return f"{OBJECT_BACKEND}-{weights_key(weights)}-{IMAGE_SIZE}"
+
+def set_detector(detector):
+    """Replace this process's shared detector, e.g. with one that batches requests"""
+    global _detector
+    _detector = detector
+
+
+def detect_objects(image_path, detector=None):
+    if detector is None:
+        detector = get_detector()
+
+    # Extract information (coordinates, labels, confidence scores)
+    detection_list = detector.detect_paths([image_path])[0]
 
     object_list = [obj['object'] for obj in detection_list]
 
@@ -36,4 +366,58 @@ def detect_objects(image_path):
 # Example usage:
 # detected_objects = detect_objects('test5.jpg')
 # print(detected_objects)
-# print(type(detect_objects))
\ No newline at end of file
+# print(type(detect_objects))
+
+if __name__ == "__main__":
+    import sys
+    import glob
+    import time
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Quantize ONNX detectors and compare detector backends")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    quantize = commands.add_parser("quantize", help="write an INT8 copy of an ONNX model")
+    quantize.add_argument("model", help="ONNX model exported by YOLOv5's export.py")
+    quantize.add_argument("output", help="quantized model to write")
+
+    parity = commands.add_parser("parity", help="check the ONNX backend against the PyTorch backend, "
+                                                "exits with status 1 when a bound is missed")
+    parity.add_argument("--onnx", default=YOLOV5_ONNX, help="ONNX model to check")
+    parity.add_argument("--images", default=os.path.join(MODULE_DIR, "../tester/indian_temples/**/*.jpg"),
+                        help="glob of images to compare on")
+    parity.add_argument("--limit", type=int, default=50, help="number of images to use")
+    parity.add_argument("--min-recall", type=float, default=PARITY_MIN_RECALL)
+    parity.add_argument("--max-extra", type=float, default=PARITY_MAX_EXTRA)
+    parity.add_argument("--confidence-tolerance", type=float, default=PARITY_CONFIDENCE_TOLERANCE)
+    parity.add_argument("--skip-missing", action="store_true",
+                        help="exit with status 0 when torch, onnxruntime or a model is not available")
+    args = parser.parse_args()
+
+    if args.command == "quantize":
+        print(f"Wrote {quantize_onnx(args.model, args.output)}")
+    else:
+        image_paths = sorted(glob.glob(args.images, recursive=True))[:args.limit]
+        if not image_paths:
+            sys.exit(f"No images match {args.images}")
+        detectors = {}
+        for name, options in (('torch', {}), ('onnx', {'model_path': args.onnx})):
+            start = time.perf_counter()
+            try:
+                detectors[name] = ObjectDetector(name, **options)
+            except (ImportError, FileNotFoundError) as e:
+                print(f"{name}: not available: {e}")
+                sys.exit(0 if args.skip_missing else 2)
+            print(f"{name}: loaded in {time.perf_counter() - start:.2f}s")
+        for name, detector in detectors.items():
+            start = time.perf_counter()
+            for image_path in image_paths:
+                detector.detect_paths([image_path])
+            print(f"{name}: {len(image_paths) / (time.perf_counter() - start):.2f} images/s")
+        report = check_backend_parity(image_paths, detectors['torch'], detectors['onnx'],
+                                      confidence_tolerance=args.confidence_tolerance)
+        print(report)
+        failures = parity_failures(report, args.min_recall, args.max_extra)
+        for failure in failures:
+            print(f"PARITY FAILED: {failure}")
+        sys.exit(1 if failures else 0)
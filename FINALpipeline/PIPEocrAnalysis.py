@@ -1,47 +1,222 @@
 import pytesseract
 from PIL import Image
 from langdetect import detect
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
 import os
+import re
+import queue
+import PIPEmetrics
+from PIPEimage import ImageContext
 
-# Set the path to Tesseract executable
-pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
+# Tesseract setup comes from the environment; the old Windows install path is only a fallback
+WINDOWS_TESSERACT = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
+if os.environ.get('TESSERACT_CMD'):
+    pytesseract.pytesseract.tesseract_cmd = os.environ['TESSERACT_CMD']
+elif os.path.exists(WINDOWS_TESSERACT):
+    pytesseract.pytesseract.tesseract_cmd = WINDOWS_TESSERACT
+
+# All languages OCR is run with when the script cannot be narrowed down
+LANGUAGES = os.environ.get('OCR_LANGUAGES', 'eng+hin+tam+tel+kan+mal+ben')
+
+# Tesseract OSD script names and the language model to load for each. Signs are often
+# bilingual, so English is always loaded next to a detected Indic script (see script_languages)
+SCRIPT_LANGUAGES = {
+    'Latin': 'eng',
+    'Devanagari': 'hin',
+    'Tamil': 'tam',
+    'Telugu': 'tel',
+    'Kannada': 'kan',
+    'Malayalam': 'mal',
+    'Bengali': 'ben'
+}
+
+# Devanagari, Bengali, Gurmukhi, Telugu, Kannada, Malayalam, Oriya and Gujarati
+INDIC_CHARS = re.compile('[\u0900-\u097F\u0980-\u09FF\u0A00-\u0A7F\u0C00-\u0C7F'
+                         '\u0C80-\u0CFF\u0D00-\u0D7F\u0B00-\u0B7F\u0A80-\u0AFF]')
+
+try:
+    # Binding to the tesseract C API, lets initialized engines be kept and reused
+    import tesserocr
+except ImportError:
+    tesserocr = None
 
 def has_indic_chars(text):
     """
     Check if the text contains Indic characters.
     """
-    ranges = [
-        (0x0900, 0x097F),  # Devanagari
-        (0x0980, 0x09FF),  # Bengali
-        (0x0A00, 0x0A7F),  # Gurmukhi
-        (0x0C00, 0x0C7F),  # Telugu
-        (0x0C80, 0x0CFF),  # Kannada
-        (0x0D00, 0x0D7F),  # Malayalam
-        (0x0B00, 0x0B7F),  # Oriya
-        (0x0A80, 0x0AFF)   # Gujarati
-    ]
-    return any(any(start <= ord(char) <= end for start, end in ranges) for char in text)
-
-def ocr_analysis(image_path):
+    return INDIC_CHARS.search(text) is not None
+
+# Text-like regions an image needs before OCR runs. Kept low so a short name board or
+# a single word still gets read; carvings and railings mostly cost an OCR call then.
+# This only saves a small part of the OCR work: on every 6th tester image, 173 of 211
+# still pass the check at 3 (68 at 12, which missed short signs)
+MIN_TEXT_REGIONS = 3
+
+def has_text_regions(image, min_regions=MIN_TEXT_REGIONS, max_side=1024):
     """
-    Performs OCR analysis on the image.
+    Cheap check for text-like regions: short, wide blobs of strong gradient.
+    Carvings and railings produce a few such blobs too, hence min_regions.
+    min_regions=0 accepts every image.
+    """
+    if min_regions <= 0:
+        return True
+    gray = np.asarray(image.convert('L'))
+    scale = max_side / max(gray.shape)
+    if scale < 1:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    height = gray.shape[0]
+
+    gradient = cv2.morphologyEx(gray, cv2.MORPH_GRADIENT, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3)))
+    _, binary = cv2.threshold(gradient, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    # Join characters of a word or line into one blob
+    joined = cv2.morphologyEx(binary, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, (9, 1)))
+    contours, _ = cv2.findContours(joined, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    regions = 0
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        if h < 8 or h > 0.2 * height or w < 1.5 * h:
+            continue
+        fill = cv2.countNonZero(binary[y:y + h, x:x + w]) / (w * h)
+        if 0.2 < fill < 0.9:
+            regions += 1
+            if regions >= min_regions:
+                return True
+    return False
+
+
+class OCREngine:
+    """OCR with a persistent worker pool, a text-presence check and script detection
+
+    With tesserocr installed, initialized tesseract instances are kept per
+    language set and reused across images; otherwise each call goes through
+    pytesseract. Images with fewer than min_text_regions text-like regions skip
+    OCR, and when the script can be detected only its language model is used.
     """
-    # Load the image
-    if not os.path.exists(image_path):
-        raise FileNotFoundError(f"Image not found: {image_path}")
 
-    image = Image.open(image_path)
+    def __init__(self, languages=LANGUAGES, workers=None, text_check=True, detect_script=True,
+                 min_text_regions=MIN_TEXT_REGIONS):
+        self.languages = languages
+        self.text_check = text_check
+        self.min_text_regions = min_text_regions
+        self.detect_script = detect_script
+        workers = workers or int(os.environ.get('OCR_WORKERS', 2))
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ocr')
+        self.tessdata = os.environ.get('TESSDATA_PREFIX')
+        self._apis = {}  # language set -> queue of idle tesserocr instances
+
+    def _acquire_api(self, lang):
+        idle = self._apis.setdefault(lang, queue.Queue())
+        try:
+            return idle.get_nowait()
+        except queue.Empty:
+            if self.tessdata:
+                return tesserocr.PyTessBaseAPI(path=self.tessdata, lang=lang)
+            return tesserocr.PyTessBaseAPI(lang=lang)
+
+    def _image_to_string(self, image, lang):
+        if tesserocr is None:
+            return pytesseract.image_to_string(image, lang=lang)
+        api = self._acquire_api(lang)
+        try:
+            api.SetImage(image)
+            return api.GetUTF8Text()
+        finally:
+            self._apis[lang].put(api)
+
+    def script_languages(self, image):
+        """Language models for the detected script, or all of them if unsure"""
+        try:
+            if tesserocr is None:
+                script = pytesseract.image_to_osd(image, output_type=pytesseract.Output.DICT)['script']
+            else:
+                api = self._acquire_api('osd')
+                try:
+                    api.SetPageSegMode(tesserocr.PSM.OSD_ONLY)
+                    api.SetImage(image)
+                    script = api.DetectOrientationScript()['script_name']
+                finally:
+                    self._apis['osd'].put(api)
+        except Exception:
+            # OSD needs a fair amount of text and fails on short snippets
+            return self.languages
+        lang = SCRIPT_LANGUAGES.get(script)
+        if lang is None:
+            return self.languages
+        # OSD reports one script; keep the English half of a bilingual sign
+        return lang if lang == 'eng' else f"{lang}+eng"
 
-    # Perform OCR
-    text = pytesseract.image_to_string(image, lang='eng+hin+tam+tel+kan+mal+ben')
+    def analyze_image(self, image, min_text_regions=None):
+        if min_text_regions is None:
+            min_text_regions = self.min_text_regions
+        if self.text_check:
+            with PIPEmetrics.span('ocr.text_check'):
+                has_text = has_text_regions(image, min_text_regions)
+            if not has_text:
+                PIPEmetrics.count('ocr.skipped_no_text')
+                return '', 'unknown', 0
 
-    # Detect language
-    detected_lang = detect(text) if text.strip() else 'unknown'
+        if self.detect_script:
+            with PIPEmetrics.span('ocr.script'):
+                lang = self.script_languages(image)
+        else:
+            lang = self.languages
 
-    # Check for Indic scripts
-    script_score = 1 if has_indic_chars(text) else 0
+        # Perform OCR
+        with PIPEmetrics.span('ocr.recognize', lang=lang):
+            text = self._image_to_string(image, lang)
 
-    return text, detected_lang, script_score
+        # Detect language
+        detected_lang = detect(text) if text.strip() else 'unknown'
+
+        # Check for Indic scripts
+        script_score = 1 if has_indic_chars(text) else 0
+
+        return text, detected_lang, script_score
+
+    def analyze(self, image_path, min_text_regions=None):
+        if isinstance(image_path, ImageContext):
+            return self.analyze_image(image_path.pil, min_text_regions)
+
+        # Load the image
+        if not os.path.exists(image_path):
+            raise FileNotFoundError(f"Image not found: {image_path}")
+
+        with Image.open(image_path) as image:
+            image.load()
+            return self.analyze_image(image, min_text_regions)
+
+    def submit(self, image_path, min_text_regions=None):
+        """Queue an image on the worker pool, returns a Future"""
+        return self.executor.submit(self.analyze, image_path, min_text_regions)
+
+
+# One engine per process, created on first use
+_engine = None
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        _engine = OCREngine()
+    return _engine
+
+def _reset_after_fork():
+    # The engine's worker threads do not survive a fork; a forked process builds its own engine
+    global _engine
+    _engine = None
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+def ocr_analysis(image_path, min_text_regions=None):
+    """
+    Performs OCR analysis on the image.
+    OCR is skipped for images with fewer than min_text_regions text-like
+    regions (default MIN_TEXT_REGIONS, 0 always runs it).
+    """
+    return get_engine().submit(image_path, min_text_regions).result()
 
 # Example usage
 if __name__ == "__main__":
@@ -0,0 +1,108 @@
+import time
+import logging
+import PIPEmetrics
+from concurrent.futures import wait, FIRST_COMPLETED
+
+log = logging.getLogger(__name__)
+
+class StageResult:
+    """Outcome of one stage: status is 'ok', 'failed', 'timeout' or 'skipped'"""
+
+    def __init__(self, name, status, output=None, error=None, seconds=0.0):
+        self.name = name
+        self.status = status
+        self.output = output
+        self.error = error
+        self.seconds = seconds
+
+    def as_dict(self):
+        return {
+            'status': self.status,
+            'output': self.output,
+            'error': self.error,
+            'seconds': self.seconds
+        }
+
+    def __repr__(self):
+        return f"StageResult({self.name!r}, {self.status!r}, seconds={self.seconds:.3f})"
+
+
+class StageGraph:
+    """A small DAG of pipeline stages run concurrently on an executor
+
+    Each stage is a callable receiving the outputs of the stages it depends on
+    as keyword arguments. A stage starts as soon as all of its dependencies
+    have finished successfully; if one of them did not, the stage is skipped.
+    A stage that raises or runs past its timeout is reported as failed or timed
+    out instead of failing the whole graph. Python cannot interrupt a running
+    thread or a single pool process, so a timed-out stage is abandoned and its
+    result ignored, not killed. Its future is kept in abandoned: it still holds
+    an executor worker until it finishes, which callers sharing an executor
+    between graphs need to know.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.abandoned = []
+
+    def add(self, name, func, depends_on=(), timeout=None):
+        for dependency in depends_on:
+            if dependency not in self.stages:
+                raise ValueError(f"Stage {name} depends on unknown stage {dependency}")
+        self.stages[name] = (func, tuple(depends_on), timeout)
+        return self
+
+    def run(self, executor, default_timeout=None):
+        """Run every stage and return a dict of StageResult by stage name"""
+        results = {}
+        running = {}  # future -> (name, start time, deadline)
+        waiting = dict(self.stages)
+
+        while waiting or running:
+            # Start every stage whose dependencies are settled
+            for name, (func, depends_on, timeout) in list(waiting.items()):
+                if any(dependency not in results for dependency in depends_on):
+                    continue
+                del waiting[name]
+                failed = [d for d in depends_on if results[d].status != 'ok']
+                if failed:
+                    results[name] = StageResult(name, 'skipped', error=f"dependencies not ok: {failed}")
+                    continue
+                inputs = {dependency: results[dependency].output for dependency in depends_on}
+                timeout = timeout if timeout is not None else default_timeout
+                start = time.perf_counter()
+                deadline = start + timeout if timeout is not None else None
+                running[executor.submit(func, **inputs)] = (name, start, deadline)
+
+            if not running:
+                continue
+
+            deadlines = [deadline for _, _, deadline in running.values() if deadline is not None]
+            wait_for = max(min(deadlines) - time.perf_counter(), 0) if deadlines else None
+            finished, _ = wait(running, timeout=wait_for, return_when=FIRST_COMPLETED)
+
+            now = time.perf_counter()
+            for future in finished:
+                name, start, _ = running.pop(future)
+                try:
+                    results[name] = StageResult(name, 'ok', output=future.result(), seconds=now - start)
+                except Exception as e:
+                    results[name] = StageResult(name, 'failed', error=f"{type(e).__name__}: {e}",
+                                                seconds=now - start)
+
+            for future, (name, start, deadline) in list(running.items()):
+                if deadline is not None and now >= deadline:
+                    del running[future]
+                    if future.cancel():
+                        # Never got a worker, nothing is left running
+                        PIPEmetrics.count('stages.timeout_queued')
+                        error = f"not started after {deadline - start:.1f}s"
+                    else:
+                        self.abandoned.append(future)
+                        PIPEmetrics.count('stages.abandoned')
+                        log.warning("Stage %s timed out after %.1fs and keeps running in the background",
+                                    name, deadline - start)
+                        error = f"no result after {deadline - start:.1f}s"
+                    results[name] = StageResult(name, 'timeout', error=error, seconds=now - start)
+
+        return results
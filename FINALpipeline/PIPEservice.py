@@ -0,0 +1,331 @@
+import os
+import json
+import time
+import socket
+import asyncio
+import logging
+import argparse
+import threading
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+log = logging.getLogger(__name__)
+
+# Largest request body accepted, requests only carry a path and a caption
+MAX_BODY = 1 << 20
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large',
+               500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+class BatchingDetector:
+    """Collects detect() calls from concurrent requests into batched forward passes
+
+    Each call blocks its (stage) thread until the batch it joined has run. A
+    batch is sent as soon as max_batch images are waiting, or window seconds
+    after its first image arrived, whichever comes first.
+    """
+
+    def __init__(self, detector, loop, window=0.01, max_batch=8):
+        self.detector = detector
+        self.names = detector.names
+        self.key = detector.key
+        self.loop = loop
+        self.window = window
+        self.max_batch = max_batch
+        self.queue = asyncio.Queue()
+        # Inference runs off the event loop, one batch at a time
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='inference')
+
+    def detect(self, images):
+        future = asyncio.run_coroutine_threadsafe(self._submit(list(images)), self.loop)
+        return future.result()
+
+    async def _submit(self, images):
+        pending = [self.loop.create_future() for _ in images]
+        for image, future in zip(images, pending):
+            await self.queue.put((image, future))
+        return [await future for future in pending]
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            deadline = self.loop.time() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - self.loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            images = [image for image, _ in batch]
+            try:
+                results = await self.loop.run_in_executor(self.executor, self.detector.detect, images)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), detections in zip(batch, results):
+                future.set_result(detections)
+
+
+class ScoringService:
+    """Long-running scorer: models stay loaded and requests share them
+
+    Requests wait in a bounded queue and are scored by a fixed number of
+    concurrent main.main calls; when the queue is full new requests are
+    turned away with 503 so callers back off instead of piling up. Object
+    detection goes through a BatchingDetector, so concurrent requests share
+    forward passes.
+
+    The protocol is plain HTTP/1.1 with JSON bodies, over TCP or a Unix socket:
+    POST /score with {"image_path", "caption", optional "lazy"} returns
+    {"score", "scores", "skipped"}; GET /health returns the queue state.
+    """
+
+    def __init__(self, workers=4, queue_size=64, batch_window=0.01, max_batch=8, use_cache=True,
+                 lazy=False, max_side=None, shard_dir=None):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.use_cache = use_cache
+        self.lazy = lazy
+        self.max_side = max_side
+        self.shard_dir = shard_dir
+        self.scored = 0
+
+    def _load(self, loop):
+        # Import and warm everything before the first request arrives
+        import main
+        import PIPEobject_detection
+        from PIPEcache import VisionCache
+        from PIPEshards import ShardStore
+        from PIPEocrAnalysis import get_engine
+
+        self.main = main
+        self.batcher = BatchingDetector(PIPEobject_detection.get_detector(), loop,
+                                        self.batch_window, self.max_batch)
+        PIPEobject_detection.set_detector(self.batcher)
+        get_engine()
+        self.cache = VisionCache() if self.use_cache else None
+        self.shards = ShardStore(self.shard_dir) if self.shard_dir else None
+
+    def _score(self, request):
+        lazy = request.get('lazy', self.lazy)
+        score, details = self.main.main(request['image_path'], request['caption'], cache=self.cache, lazy=lazy,
+                                        return_details=True, max_side=self.max_side, shard_store=self.shards)
+        return {'score': score, 'scores': details['scores'], 'skipped': details['skipped']}
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            request, future = await self.queue.get()
+            try:
+                result = await loop.run_in_executor(self.executor, self._score, request)
+                self.scored += 1
+                future.set_result((200, result))
+            except Exception as e:
+                log.exception("Scoring %s failed", request.get('image_path'))
+                future.set_result((500, {'error': f"{type(e).__name__}: {e}"}))
+            finally:
+                self.queue.task_done()
+
+    async def _dispatch(self, method, target, body):
+        path = urlsplit(target).path
+        if method == 'GET' and path == '/health':
+            return 200, {'status': 'ok', 'queued': self.queue.qsize(), 'queue_size': self.queue_size,
+                         'workers': self.workers, 'scored': self.scored}
+        if method != 'POST' or path != '/score':
+            return 404, {'error': f"no route for {method} {path}"}
+
+        try:
+            request = json.loads(body)
+        except ValueError:
+            request = None
+        if not isinstance(request, dict) or 'image_path' not in request or 'caption' not in request:
+            return 400, {'error': 'body must be JSON with image_path and caption'}
+
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((request, future))
+        except asyncio.QueueFull:
+            return 503, {'error': 'queue full, retry later'}
+        return await future
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                except ValueError:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', 0) or 0)
+                if length > MAX_BODY:
+                    status, payload = 413, {'error': 'request too large'}
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length) if length else b''
+                    status, payload = await self._dispatch(method, path, body)
+                    keep_alive = headers.get('connection', '').lower() != 'close'
+
+                data = json.dumps(payload).encode()
+                head = [f"HTTP/1.1 {status} {STATUS_TEXT[status]}",
+                        "Content-Type: application/json",
+                        f"Content-Length: {len(data)}",
+                        f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+                if status == 503:
+                    head.append("Retry-After: 1")
+                writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8765, unix_socket=None):
+        loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='score')
+
+        start = time.perf_counter()
+        await loop.run_in_executor(None, self._load, loop)
+        log.info("Models loaded in %.1fs", time.perf_counter() - start)
+
+        tasks = [asyncio.ensure_future(self.batcher.run())]
+        tasks += [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+        if unix_socket:
+            if os.path.exists(unix_socket):
+                os.unlink(unix_socket)
+            server = await asyncio.start_unix_server(self._handle, path=unix_socket)
+            log.info("Listening on unix:%s", unix_socket)
+        else:
+            server = await asyncio.start_server(self._handle, host, port)
+            log.info("Listening on http://%s:%d", host, port)
+
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.executor.shutdown(wait=False)
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+class ScoringClient:
+    """Thin, thread-safe client for ScoringService
+
+    address is "http://host:port" or "unix:/path/to/socket". Each thread keeps
+    its own connection. Requests the service turns away because its queue is
+    full are retried with exponential backoff, up to retries times.
+    """
+
+    def __init__(self, address, timeout=600, retries=8):
+        self.address = address
+        self.timeout = timeout
+        self.retries = retries
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if self.address.startswith('unix:'):
+                conn = _UnixHTTPConnection(self.address[len('unix:'):], timeout=self.timeout)
+            else:
+                url = urlsplit(self.address)
+                conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=self.timeout)
+            self._local.conn = conn
+        return conn
+
+    def _request(self, method, path, payload=None):
+        body = json.dumps(payload) if payload is not None else None
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        delay = 0.25
+        for attempt in range(self.retries + 1):
+            conn = self._connection()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                status, data = response.status, json.loads(response.read())
+            except (ConnectionError, http.client.HTTPException):
+                # Stale keep-alive connection; reconnect once per attempt
+                conn.close()
+                self._local.conn = None
+                if attempt == self.retries:
+                    raise
+                continue
+            if status == 503 and attempt < self.retries:
+                time.sleep(delay)
+                delay = min(delay * 2, 8)
+                continue
+            if status != 200:
+                raise RuntimeError(f"Scoring service returned {status}: {data.get('error')}")
+            return data
+        raise RuntimeError("Scoring service is overloaded")
+
+    def score(self, image_path, caption, lazy=None, details=False):
+        """Final score for the pair, or the full response with details=True"""
+        request = {'image_path': os.path.abspath(image_path), 'caption': caption}
+        if lazy is not None:
+            request['lazy'] = lazy
+        result = self._request('POST', '/score', request)
+        return result if details else result['score']
+
+    def health(self):
+        return self._request('GET', '/health')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the scoring pipeline with models kept loaded")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--socket", default=None, help="listen on this Unix socket instead of TCP")
+    parser.add_argument("--workers", type=int, default=4, help="pairs scored concurrently")
+    parser.add_argument("--queue-size", type=int, default=64, help="waiting requests before answering 503")
+    parser.add_argument("--batch-window-ms", type=float, default=10,
+                        help="how long a detection batch waits for more images")
+    parser.add_argument("--max-batch", type=int, default=8, help="largest detection batch")
+    parser.add_argument("--no-cache", action="store_true", help="do not use the vision cache")
+    parser.add_argument("--lazy", action="store_true", help="skip stages that cannot score, unless a request says otherwise")
+    parser.add_argument("--max-side", type=int, default=None, help="cap on the decoded image size")
+    parser.add_argument("--shards", default=None, help="read images from shards packed by PIPEshards.py")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+    # Per stage progress of every request would drown the service log
+    logging.getLogger('main').setLevel(logging.WARNING)
+
+    service = ScoringService(args.workers, args.queue_size, args.batch_window_ms / 1000, args.max_batch,
+                             not args.no_cache, args.lazy, args.max_side, args.shards)
+    try:
+        asyncio.run(service.serve(args.host, args.port, args.socket))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,152 @@
+import os
+import json
+import hashlib
+import argparse
+import numpy as np
+from PIPEimage import ImageContext
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp')
+
+# Keep every image's pixels aligned for fast memory-mapped access
+ALIGNMENT = 64
+
+
+def pack_directory(root, output_dir, max_side=1024, shard_bytes=1 << 30):
+    """Decode every image under root into memory-mappable shard files
+
+    Images are decoded once (capped at max_side, see ImageContext) and their
+    uint8 BGR pixels appended to shard_NNNN.bin files of about shard_bytes
+    each. index.json records, for every image path relative to root, the
+    content hash, original size, shard, offset and shape. Files with identical
+    content share one copy of the pixels.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    root = os.path.abspath(root)
+
+    paths = []
+    for directory, _, filenames in os.walk(root):
+        for filename in sorted(filenames):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(directory, filename))
+    paths.sort()
+
+    entries = {}
+    by_hash = {}
+    shard_id = 0
+    shard = None
+    offset = 0
+
+    for path in paths:
+        with open(path, 'rb') as f:
+            content_hash = hashlib.sha1(f.read()).hexdigest()
+        key = os.path.relpath(path, root)
+
+        if content_hash in by_hash:
+            entries[key] = dict(by_hash[content_hash])
+            continue
+
+        try:
+            context = ImageContext(path, max_side)
+            pixels = context.bgr
+        except Exception as e:
+            print(f"Error: Could not decode {path}: {e}")
+            continue
+
+        if shard is None or offset + pixels.nbytes > shard_bytes:
+            if shard is not None:
+                shard.close()
+                shard_id += 1
+            shard = open(os.path.join(output_dir, f"shard_{shard_id:04d}.bin"), 'wb')
+            offset = 0
+
+        shard.write(pixels.tobytes())
+        entry = {
+            'hash': content_hash,
+            'original_size': list(context.original_size),
+            'shard': shard_id,
+            'offset': offset,
+            'shape': list(pixels.shape)
+        }
+        offset += pixels.nbytes
+        padding = -offset % ALIGNMENT
+        shard.write(b'\0' * padding)
+        offset += padding
+
+        entries[key] = entry
+        by_hash[content_hash] = entry
+
+    if shard is not None:
+        shard.close()
+
+    with open(os.path.join(output_dir, 'index.json'), 'w') as f:
+        json.dump({'root': root, 'max_side': max_side, 'images': entries}, f)
+
+    print(f"Packed {len(entries)} images ({len(by_hash)} unique) into {shard_id + 1 if shard else 0} shards")
+    return entries
+
+
+class ShardStore:
+    """Read-only, zero-copy access to images packed by pack_directory
+
+    Shards are memory-mapped on first use, so every process reading the same
+    store shares the pages through the OS page cache. Pickling a store only
+    carries its directory and index; each process maps the shards itself.
+    """
+
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        with open(os.path.join(shard_dir, 'index.json')) as f:
+            index = json.load(f)
+        self.root = index['root']
+        self.max_side = index['max_side']
+        self.images = index['images']
+        self._shards = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+    def _key(self, path):
+        # Paths resolving under the packed root, otherwise paths given relative to it
+        relative = os.path.relpath(os.path.abspath(path), self.root)
+        if relative in self.images:
+            return relative
+        return os.path.normpath(path.lstrip('/'))
+
+    def __contains__(self, path):
+        return self._key(path) in self.images
+
+    def entry(self, path):
+        return self.images[self._key(path)]
+
+    def get(self, path):
+        """The image's BGR pixels as a read-only view into its shard"""
+        entry = self.entry(path)
+        shard = self._shards.get(entry['shard'])
+        if shard is None:
+            shard = np.memmap(os.path.join(self.shard_dir, f"shard_{entry['shard']:04d}.bin"),
+                              dtype=np.uint8, mode='r')
+            self._shards[entry['shard']] = shard
+        size = int(np.prod(entry['shape']))
+        return shard[entry['offset']:entry['offset'] + size].reshape(entry['shape'])
+
+    def context(self, path):
+        """An ImageContext backed by the shard, ready to hand to the pipeline stages"""
+        entry = self.entry(path)
+        context = ImageContext.from_array(self.get(path), path)
+        context.original_size = tuple(entry['original_size'])
+        context.max_side = self.max_side
+        context.content_hash = entry['hash']
+        return context
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack an image directory tree into memory-mapped shards")
+    parser.add_argument("root", help="directory to pack, e.g. ../tester/indian_temples")
+    parser.add_argument("output_dir", help="where to write the shards and index.json")
+    parser.add_argument("--max-side", type=int, default=1024, help="cap on the longest side of stored images")
+    parser.add_argument("--shard-mb", type=int, default=1024, help="approximate size of each shard file")
+    args = parser.parse_args()
+
+    pack_directory(args.root, args.output_dir, args.max_side, args.shard_mb << 20)
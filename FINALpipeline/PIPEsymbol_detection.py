@@ -1,132 +1,523 @@
 import cv2
 import os
+import hashlib
+import logging
+import multiprocessing
 import numpy as np
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import PIPEmetrics
+from PIPEimage import ImageContext
 
-def detect_symbols(sample_image_path, symbols_dir, min_scale=0.1, max_scale=1.0, scale_steps=20, threshold=0.5):
-    # Load the sample image
-    sample_image = cv2.imread(sample_image_path)
-    if sample_image is None:
-        print(f"Error: Could not load image at {sample_image_path}")
-        return
-    
-    # Convert sample image to grayscale
-    gray_sample_image = cv2.cvtColor(sample_image, cv2.COLOR_BGR2GRAY)
+log = logging.getLogger(__name__)
+
+SYMBOL_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+
+class SymbolTemplateBank:
+    """Grayscale symbol templates loaded and pre-scaled once, reused for every image
+
+    The prepared templates can be persisted to an .npz file under cache_dir. The
+    file name is derived from the template file contents and the scale
+    parameters, so editing the symbols directory or the scales never picks up a
+    stale bank. A built bank is only read from, so it can be shared by worker
+    processes.
+    """
+
+    def __init__(self, symbols_dir, min_scale=0.1, max_scale=1.0, scale_steps=20, cache_dir=None):
+        self.symbols_dir = symbols_dir
+        self.scales = np.linspace(min_scale, max_scale, scale_steps)
+
+        # (symbol_filename, scale, template) for every usable scale of every symbol
+        self.templates = []
+
+        symbol_files = sorted(
+            name for name in os.listdir(symbols_dir) if name.lower().endswith(SYMBOL_EXTENSIONS)
+        )
+        self.key = self._make_key(symbol_files)
+
+        cache_path = None
+        if cache_dir is not None:
+            cache_path = os.path.join(cache_dir, f"symbol_bank_{self.key}.npz")
+            if os.path.exists(cache_path):
+                self._load(cache_path)
+                return
+
+        self._build(symbol_files)
+        if cache_path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._save(cache_path)
+
+    def _make_key(self, symbol_files):
+        """Hash the template files and the scale parameters"""
+        digest = hashlib.sha1(self.scales.tobytes())
+        for symbol_filename in symbol_files:
+            digest.update(symbol_filename.encode())
+            with open(os.path.join(self.symbols_dir, symbol_filename), 'rb') as f:
+                digest.update(hashlib.sha1(f.read()).digest())
+        return digest.hexdigest()[:16]
+
+    def _build(self, symbol_files):
+        for symbol_filename in symbol_files:
+            symbol_path = os.path.join(self.symbols_dir, symbol_filename)
+            symbol = cv2.imread(symbol_path, 0)  # Load symbol in grayscale
+
+            if symbol is None:
+                log.error("Could not load symbol at %s", symbol_path)
+                continue
+
+            symbol_height, symbol_width = symbol.shape
+            for scale in self.scales:
+                width = int(symbol_width * scale)
+                height = int(symbol_height * scale)
+
+                # Skip if dimensions are invalid
+                if width < 10 or height < 10:  # Too small
+                    continue
+
+                resized_symbol = cv2.resize(symbol, (width, height))
+                self.templates.append((symbol_filename, float(scale), resized_symbol))
+
+    def _save(self, cache_path):
+        """Store all templates as one flat pixel buffer plus an index"""
+        shapes = np.array([t.shape for _, _, t in self.templates], dtype=np.int32).reshape(-1, 2)
+        pixels = np.concatenate([t.ravel() for _, _, t in self.templates]) if self.templates \
+            else np.zeros(0, dtype=np.uint8)
+        # Write to a temporary file first so concurrent readers never see a partial bank
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path,
+                 names=np.array([name for name, _, _ in self.templates], dtype=str),
+                 scales=np.array([scale for _, scale, _ in self.templates], dtype=np.float64),
+                 shapes=shapes,
+                 pixels=pixels)
+        os.replace(tmp_path, cache_path)
+
+    def _load(self, cache_path):
+        with np.load(cache_path) as data:
+            names, scales, shapes, pixels = data['names'], data['scales'], data['shapes'], data['pixels']
+        offset = 0
+        for name, scale, (height, width) in zip(names, scales, shapes):
+            size = height * width
+            template = pixels[offset:offset + size].reshape(height, width)
+            self.templates.append((str(name), float(scale), template))
+            offset += size
+
+    def symbol_names(self):
+        """Template file names in the order they are matched"""
+        return list(dict.fromkeys(name for name, _, _ in self.templates))
+
+
+def _cannot_match(template_shape, image_shape):
+    # A template larger than the image in both dimensions is still matched (OpenCV swaps
+    # the two); matchTemplate only fails when it is larger in exactly one of them
+    taller = template_shape[0] > image_shape[0]
+    wider = template_shape[1] > image_shape[1]
+    return taller != wider
+
+
+def _exhaustive_responses(gray_sample_image, bank):
+    """Match every template at full resolution over the whole image"""
+    current_symbol = None
+    for symbol_filename, scale, resized_symbol in bank.templates:
+        if symbol_filename != current_symbol:
+            log.debug("Processing symbol: %s", symbol_filename)
+            current_symbol = symbol_filename
+        if _cannot_match(resized_symbol.shape, gray_sample_image.shape):
+            # matchTemplate would raise for this scale, nothing to match
+            PIPEmetrics.count('symbols.templates_skipped')
+            continue
+        try:
+            # Perform template matching
+            result = cv2.matchTemplate(gray_sample_image, resized_symbol, cv2.TM_CCOEFF_NORMED)
+        except cv2.error as e:
+            log.warning("Error processing scale %s for %s: %s", scale, symbol_filename, e)
+            continue
+        PIPEmetrics.count('symbols.templates_matched')
+        yield symbol_filename, resized_symbol, result
+
+
+def _coarse_to_fine_responses(gray_sample_image, bank, threshold, coarse_factor=0.5,
+                              coarse_margin=0.1, keep_scales=2):
+    """Match on a downsampled image first, then only refine promising regions
+
+    Every template is matched once against the image shrunk by coarse_factor.
+    For each symbol only the keep_scales best scoring scales (and their
+    neighbouring scales) are refined, and only inside the regions where the
+    coarse response reached threshold - coarse_margin. Positions outside those
+    regions are left at -1 in the returned full resolution response map.
+    Scales the coarse level cannot judge (too small, or larger than the image)
+    are always matched in full.
+
+    Measured on 12 tester images of 0.07-2 MP on one core: 0.9-4.5 s per image
+    against 1-19 s for exhaustive search, with every symbol the exhaustive
+    search found also found. It is not under a second per image except on the
+    smallest images.
+    """
+    image_height, image_width = gray_sample_image.shape
+    gray_small = cv2.resize(gray_sample_image, None, fx=coarse_factor, fy=coarse_factor,
+                            interpolation=cv2.INTER_AREA)
+    coarse_threshold = threshold - coarse_margin
+    pad = int(np.ceil(1 / coarse_factor)) + 2
+
+    # Group the bank's templates by symbol, keeping the scale order
+    by_symbol = {}
+    for symbol_filename, scale, resized_symbol in bank.templates:
+        by_symbol.setdefault(symbol_filename, []).append(resized_symbol)
+
+    for symbol_filename, templates in by_symbol.items():
+        log.debug("Processing symbol: %s", symbol_filename)
+
+        # Coarse pass over all scales that can be matched at all
+        coarse = []
+        for resized_symbol in templates:
+            height, width = resized_symbol.shape
+            small_width = int(width * coarse_factor)
+            small_height = int(height * coarse_factor)
+            if _cannot_match(resized_symbol.shape, gray_sample_image.shape):
+                coarse.append(None)
+            elif height > image_height or small_width < 5 or small_height < 5 or \
+                    small_height > gray_small.shape[0] or small_width > gray_small.shape[1]:
+                # Too small, too tight a fit or larger than the image: cannot be judged at the coarse level
+                coarse.append((None, None))
+            else:
+                small_symbol = cv2.resize(resized_symbol, (small_width, small_height),
+                                          interpolation=cv2.INTER_AREA)
+                result = cv2.matchTemplate(gray_small, small_symbol, cv2.TM_CCOEFF_NORMED)
+                coarse.append((float(result.max()), result))
+
+        # Scales the coarse pass could not judge are always refined, the others only
+        # around the best coarse scores, ranked among themselves
+        keep = {i for i, c in enumerate(coarse) if c is not None and c[0] is None}
+        ranked = sorted((i for i, c in enumerate(coarse)
+                         if c is not None and c[0] is not None and c[0] >= coarse_threshold),
+                        key=lambda i: coarse[i][0], reverse=True)
+        for i in ranked[:keep_scales]:
+            keep.update(j for j in (i - 1, i, i + 1) if 0 <= j < len(coarse) and coarse[j] is not None)
+
+        for i in sorted(keep):
+            resized_symbol = templates[i]
+            height, width = resized_symbol.shape
+            coarse_result = coarse[i][1]
+            if coarse_result is None:
+                yield symbol_filename, resized_symbol, cv2.matchTemplate(
+                    gray_sample_image, resized_symbol, cv2.TM_CCOEFF_NORMED)
+                continue
+
+            result_height = image_height - height + 1
+            result_width = image_width - width + 1
+            result = np.full((result_height, result_width), -1, dtype=np.float32)
+
+            # Refine each connected candidate region at full resolution
+            candidates = (coarse_result >= coarse_threshold).astype(np.uint8)
+            count, _, stats, _ = cv2.connectedComponentsWithStats(candidates)
+            for x, y, w, h, _ in stats[1:count]:
+                x0 = max(int(x / coarse_factor) - pad, 0)
+                y0 = max(int(y / coarse_factor) - pad, 0)
+                x1 = min(int((x + w) / coarse_factor) + pad, result_width)
+                y1 = min(int((y + h) / coarse_factor) + pad, result_height)
+                roi = gray_sample_image[y0:y1 + height - 1, x0:x1 + width - 1]
+                result[y0:y1, x0:x1] = cv2.matchTemplate(roi, resized_symbol, cv2.TM_CCOEFF_NORMED)
+            yield symbol_filename, resized_symbol, result
+
+
+# The bank of a ParallelSymbolMatcher pool process, set by _init_match_worker
+_worker_bank = None
+
+def _init_match_worker(bank):
+    global _worker_bank
+    _worker_bank = bank
+    # The pool provides the parallelism; more OpenCV threads per process would oversubscribe the cores
+    cv2.setNumThreads(1)
+
+def _match_templates(gray_sample_image, templates, indices, threshold, peak_size):
+    """Peaks of the templates at the given indices, as (index, xs, ys, scores) in index order"""
+    found = []
+    for index in indices:
+        symbol_filename, scale, resized_symbol = templates[index]
+        if _cannot_match(resized_symbol.shape, gray_sample_image.shape):
+            continue
+        try:
+            result = cv2.matchTemplate(gray_sample_image, resized_symbol, cv2.TM_CCOEFF_NORMED)
+        except cv2.error as e:
+            log.warning("Error processing scale %s for %s: %s", scale, symbol_filename, e)
+            continue
+        found.append((index,) + extract_peaks(result, threshold, peak_size))
+    return found
+
+def _match_shared(shm_name, shape, indices, threshold, peak_size):
+    # Runs in a pool process: read the image straight from the shared memory block
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        gray_sample_image = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        found = _match_templates(gray_sample_image, _worker_bank.templates, indices, threshold, peak_size)
+        del gray_sample_image
+        return found
+    finally:
+        shm.close()
+
+
+class ParallelSymbolMatcher:
+    """Spreads the (symbol, scale) templates of a bank over a pool of workers
+
+    With kind='process' each of the worker processes receives the bank once
+    when it starts, and the grayscale image of every call is placed in shared
+    memory, so only its name is sent to the workers. With kind='thread' the
+    image and templates are shared directly; OpenCV releases the GIL while
+    matching. Work units are chunks of template indices, interleaved so each
+    chunk mixes large and small templates. Results are put back in template
+    order, so the detections are the same for any worker count and the same
+    as the serial exhaustive search.
+    """
+
+    def __init__(self, bank, workers=None, kind='process', chunks_per_worker=4):
+        self.bank = bank
+        self.workers = workers or os.cpu_count()
+        self.kind = kind
+        self.chunks_per_worker = chunks_per_worker
+        if kind == 'process':
+            # Workers start from a clean process rather than a fork of a possibly threaded parent
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context,
+                                                initializer=_init_match_worker, initargs=(bank,))
+        elif kind == 'thread':
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='symbols')
+        else:
+            raise ValueError(f"Unknown worker kind: {kind}")
+
+    def _chunks(self):
+        count = len(self.bank.templates)
+        chunks = min(count, self.workers * self.chunks_per_worker)
+        return [range(start, count, chunks) for start in range(chunks)]
+
+    def match(self, gray_sample_image, threshold, peak_size=1):
+        """Peaks of every template, as (template index, xs, ys, scores) sorted by template index"""
+        if self.kind == 'thread':
+            futures = [self.executor.submit(_match_templates, gray_sample_image, self.bank.templates,
+                                            chunk, threshold, peak_size) for chunk in self._chunks()]
+            found = [item for future in futures for item in future.result()]
+        else:
+            gray_sample_image = np.ascontiguousarray(gray_sample_image, dtype=np.uint8)
+            shm = shared_memory.SharedMemory(create=True, size=max(gray_sample_image.nbytes, 1))
+            try:
+                np.ndarray(gray_sample_image.shape, dtype=np.uint8, buffer=shm.buf)[:] = gray_sample_image
+                futures = [self.executor.submit(_match_shared, shm.name, gray_sample_image.shape, chunk,
+                                                threshold, peak_size) for chunk in self._chunks()]
+                found = [item for future in futures for item in future.result()]
+            finally:
+                shm.close()
+                shm.unlink()
+        found.sort(key=lambda item: item[0])
+        PIPEmetrics.count('symbols.templates_matched', len(found))
+        return found
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def extract_peaks(result, threshold, peak_size=1):
+    """Positions and scores of the local maxima of a response map at or above threshold
+
+    peak_size is the side of the neighbourhood a peak must dominate; 1 keeps
+    every position above threshold.
+    """
+    candidates = result >= threshold
+    if peak_size > 1:
+        dilated = cv2.dilate(result, np.ones((peak_size, peak_size), np.uint8))
+        candidates &= result >= dilated
+    ys, xs = np.nonzero(candidates)
+    return xs, ys, result[ys, xs]
+
+
+def box_iou(box, boxes):
+    """IoU between one [x1, y1, x2, y2] box and an (N, 4) array of boxes"""
+    inter_width = np.minimum(box[2], boxes[:, 2]) - np.maximum(box[0], boxes[:, 0])
+    inter_height = np.minimum(box[3], boxes[:, 3]) - np.maximum(box[1], boxes[:, 1])
+    intersection = np.clip(inter_width, 0, None) * np.clip(inter_height, 0, None)
+
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    union = area + areas - intersection
+
+    iou = np.zeros(len(boxes), dtype=np.float64)
+    np.divide(intersection, union, out=iou, where=union > 0)
+    return iou
+
+
+def non_max_suppression(boxes, scores, iou_threshold=0.3, class_ids=None):
+    """Greedy NMS, returns the indices of the kept boxes by descending score
+
+    With class_ids given, boxes only suppress boxes of the same class.
+    """
+    order = np.argsort(-scores, kind='stable')
+    keep = []
+    while order.size > 0:
+        best = order[0]
+        keep.append(best)
+        rest = order[1:]
+
+        suppress = box_iou(boxes[best], boxes[rest]) >= iou_threshold
+        if class_ids is not None:
+            suppress &= class_ids[rest] == class_ids[best]
+        order = rest[~suppress]
+    return np.array(keep, dtype=np.int64)
+
+
+def detect_symbols(sample_image_path, symbols_dir, min_scale=0.1, max_scale=1.0, scale_steps=20, threshold=0.5,
+                   search='exhaustive', coarse_factor=0.5, coarse_margin=0.1, keep_scales=2,
+                   peak_size=1, iou_threshold=0.3, class_aware=False, matcher=None):
+    """Find symbols in the image by multi-scale template matching
+
+    sample_image_path may be a file path or a shared ImageContext.
+    symbols_dir may be a directory of symbol images or a prepared
+    SymbolTemplateBank; with a bank, the bank's own scales are used and
+    min_scale, max_scale and scale_steps are ignored.
+
+    search='exhaustive' matches every template at every scale over the full
+    image. search='coarse' uses the coarse-to-fine search of
+    _coarse_to_fine_responses, tuned by coarse_factor, coarse_margin and
+    keep_scales; use check_coarse_recall to compare it with exhaustive search.
+
+    Every position at or above threshold becomes a candidate, and all of them
+    go through one vectorized NMS pass, per symbol when class_aware is set.
+    peak_size > 1 keeps only local maxima (see extract_peaks), which is faster
+    (about 30% less time with 3) but not equivalent: a non-maximal position
+    can suppress a box that a peak would not, so symbols can appear or vanish.
+
+    With a ParallelSymbolMatcher as matcher, exhaustive search is spread over
+    its pool and its bank is used; the detections do not change.
+    """
+    if isinstance(sample_image_path, ImageContext):
+        # Shared, already decoded image
+        sample_image = sample_image_path.bgr
+        gray_sample_image = sample_image_path.gray
+    else:
+        # Load the sample image
+        sample_image = cv2.imread(sample_image_path)
+        if sample_image is None:
+            log.error("Could not load image at %s", sample_image_path)
+            return
+        
+        # Convert sample image to grayscale
+        gray_sample_image = cv2.cvtColor(sample_image, cv2.COLOR_BGR2GRAY)
     sample_height, sample_width = gray_sample_image.shape
     
     # Create a copy for drawing results
     result_image = sample_image.copy()
     
-    # Store all detections for non-maximum suppression
-    all_detections = []
+    if matcher is not None:
+        bank = matcher.bank
+    elif isinstance(symbols_dir, SymbolTemplateBank):
+        bank = symbols_dir
+    else:
+        bank = SymbolTemplateBank(symbols_dir, min_scale, max_scale, scale_steps)
     
-    # Generate scale factors
-    scales = np.linspace(min_scale, max_scale, scale_steps)
+    if search not in ('exhaustive', 'coarse'):
+        raise ValueError(f"Unknown search mode: {search}")
     
-    # Loop through all symbol files
-    for symbol_filename in os.listdir(symbols_dir):
-        if not symbol_filename.lower().endswith(('.jpg', '.jpeg', '.png', '.webp')):
-            continue
-            
-        symbol_path = os.path.join(symbols_dir, symbol_filename)
-        symbol = cv2.imread(symbol_path, 0)  # Load symbol in grayscale
-        
-        if symbol is None:
-            print(f"Error: Could not load symbol at {symbol_path}")
-            continue
-            
-        print(f"Processing symbol: {symbol_filename}")
-        
-        # Calculate initial symbol size
-        symbol_height, symbol_width = symbol.shape
-        
-        # Multi-scale template matching
-        for scale in scales:
-            # Calculate new dimensions
-            width = int(symbol_width * scale)
-            height = int(symbol_height * scale)
-            
-            # Skip if dimensions are invalid
-            if width < 10 or height < 10:  # Too small
-                continue
-            
-            try:
-                # Resize the symbol
-                resized_symbol = cv2.resize(symbol, (width, height))
-                
-                # Perform template matching
-                result = cv2.matchTemplate(gray_sample_image, resized_symbol, cv2.TM_CCOEFF_NORMED)
-                
-                # Get positions where result exceeds threshold
-                locations = np.where(result >= threshold)
-                for pt in zip(*locations[::-1]):  # Switch columns and rows
-                    all_detections.append({
-                        'pos': pt,
-                        'size': (width, height),
-                        'conf': result[pt[1], pt[0]],
-                        'symbol_name': symbol_filename
-                    })
-            except cv2.error as e:
-                print(f"Error processing scale {scale} for {symbol_filename}: {str(e)}")
-                continue
+    # Candidate detections for non-maximum suppression, one array per template
+    all_boxes = []
+    all_scores = []
+    all_class_ids = []
+    symbol_names = bank.symbol_names()
     
-    # Non-maximum suppression
-    def calculate_iou(box1, box2):
-        b1 = [box1['pos'][0], box1['pos'][1], 
-              box1['pos'][0] + box1['size'][0], box1['pos'][1] + box1['size'][1]]
-        b2 = [box2['pos'][0], box2['pos'][1], 
-              box2['pos'][0] + box2['size'][0], box2['pos'][1] + box2['size'][1]]
-        
-        x1 = max(b1[0], b2[0])
-        y1 = max(b1[1], b2[1])
-        x2 = min(b1[2], b2[2])
-        y2 = min(b1[3], b2[3])
-        
-        if x2 < x1 or y2 < y1:
-            return 0.0
-            
-        intersection = (x2 - x1) * (y2 - y1)
-        
-        area1 = (b1[2] - b1[0]) * (b1[3] - b1[1])
-        area2 = (b2[2] - b2[0]) * (b2[3] - b2[1])
-        union = area1 + area2 - intersection
+    def add_candidates(symbol_filename, resized_symbol, xs, ys, confs):
+        height, width = resized_symbol.shape
+        all_boxes.append(np.stack([xs, ys, xs + width, ys + height], axis=1))
+        all_scores.append(confs)
+        all_class_ids.append(np.full(len(xs), symbol_names.index(symbol_filename)))
+    
+    if matcher is not None and search == 'exhaustive':
+        # Same templates and peaks as the serial loop, in the same order
+        with PIPEmetrics.span('symbols.match', search='parallel', workers=matcher.workers):
+            for index, xs, ys, confs in matcher.match(gray_sample_image, threshold, peak_size):
+                symbol_filename, _, resized_symbol = bank.templates[index]
+                add_candidates(symbol_filename, resized_symbol, xs, ys, confs)
+    else:
+        if search == 'exhaustive':
+            responses = _exhaustive_responses(gray_sample_image, bank)
+        else:
+            responses = _coarse_to_fine_responses(gray_sample_image, bank, threshold,
+                                                  coarse_factor, coarse_margin, keep_scales)
         
-        return intersection / union if union > 0 else 0
-
-    # Sort detections by confidence
-    all_detections.sort(key=lambda x: x['conf'], reverse=True)
-    final_detections = []
+        # Multi-scale template matching over the prepared templates
+        with PIPEmetrics.span('symbols.match', search=search):
+            for symbol_filename, resized_symbol, result in responses:
+                # Get local peaks where result exceeds threshold
+                add_candidates(symbol_filename, resized_symbol, *extract_peaks(result, threshold, peak_size))
+    
+    if all_boxes:
+        boxes = np.concatenate(all_boxes)
+        scores = np.concatenate(all_scores)
+        class_ids = np.concatenate(all_class_ids)
+    else:
+        boxes = np.zeros((0, 4), dtype=np.int64)
+        scores = np.zeros(0, dtype=np.float32)
+        class_ids = np.zeros(0, dtype=np.int64)
     
     # Apply non-maximum suppression
-    while len(all_detections) > 0:
-        best_detection = all_detections.pop(0)
-        final_detections.append(best_detection)
-        
-        # Filter out overlapping detections
-        all_detections = [
-            det for det in all_detections
-            if calculate_iou(best_detection, det) < 0.3
-        ]
+    with PIPEmetrics.span('symbols.nms'):
+        keep = non_max_suppression(boxes, scores, iou_threshold, class_ids if class_aware else None)
+    PIPEmetrics.count('symbols.candidates', len(boxes))
+    PIPEmetrics.count('symbols.kept', len(keep))
     
     # Draw final detections
     detected_symbols = []  # List to store detected symbol names
-    for det in final_detections:
-        pt = det['pos']
-        width, height = det['size']
-        cv2.rectangle(result_image, pt, (pt[0] + width, pt[1] + height), (0, 255, 0), 2)
+    for i in keep:
+        x_min, y_min, x_max, y_max = (int(v) for v in boxes[i])
+        symbol_name = symbol_names[class_ids[i]]
+        pt = (x_min, y_min)
+        cv2.rectangle(result_image, pt, (x_max, y_max), (0, 255, 0), 2)
         
         # Display coordinates and symbol name
-        text = f"{det['symbol_name']} ({pt[0]}, {pt[1]})"
+        text = f"{symbol_name} ({pt[0]}, {pt[1]})"
         cv2.putText(result_image, text, (pt[0], pt[1] - 10),
                     cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
         
-        print(f"Found {det['symbol_name']} at position {pt} with confidence {det['conf']:.2f}")
-        detected_symbols.append(det['symbol_name'])  # Add detected symbol name to the list
+        log.debug("Found %s at position %s with confidence %.2f", symbol_name, pt, scores[i])
+        detected_symbols.append(symbol_name)  # Add detected symbol name to the list
 
     # Remove extensions and create a unique list
     detected_symbols_unique = list(set([symbol.split('.')[0] for symbol in detected_symbols]))
 
     return detected_symbols_unique, result_image  # Return the list of detected symbols and the result image
 
+def symbol_scores(sample_image_path, symbols_dir):
+    """Best matching score of every symbol over all of its scales
+
+    A symbol is reported by detect_symbols at a given threshold only if its
+    score here reaches it (NMS against other symbols aside), which lets
+    thresholds be tuned without rerunning the matching.
+    """
+    if isinstance(sample_image_path, ImageContext):
+        gray_sample_image = sample_image_path.gray
+    else:
+        gray_sample_image = cv2.imread(sample_image_path, 0)
+    bank = symbols_dir if isinstance(symbols_dir, SymbolTemplateBank) else SymbolTemplateBank(symbols_dir)
+
+    scores = {}
+    for symbol_filename, resized_symbol, result in _exhaustive_responses(gray_sample_image, bank):
+        symbol_name = symbol_filename.split('.')[0]
+        scores[symbol_name] = max(scores.get(symbol_name, -1.0), float(result.max()))
+    return scores
+
+def check_coarse_recall(image_paths, bank, threshold=0.5, **coarse_params):
+    """Fraction of symbols found by exhaustive search that coarse search also finds"""
+    found = 0
+    expected = 0
+    for image_path in image_paths:
+        exhaustive = set(detect_symbols(image_path, bank, threshold=threshold)[0])
+        coarse = set(detect_symbols(image_path, bank, threshold=threshold, search='coarse', **coarse_params)[0])
+        expected += len(exhaustive)
+        found += len(exhaustive & coarse)
+    return found / expected if expected else 1.0
+
 # Usage example
 if __name__ == "__main__":
     # Path configurations
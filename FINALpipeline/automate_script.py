@@ -1,6 +1,13 @@
 import os
+import gc
+import sys
+import csv
 import json
-import subprocess
+import argparse
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
 
 # Input JSON files
 json_files = ["./output.json", "./output_nithin.json"]
@@ -8,39 +15,201 @@ json_files = ["./output.json", "./output_nithin.json"]
 # Output results file
 output_file = "./result_pipeline.txt"
 
-# Prepare output file header
-with open(output_file, "w") as f:
-    f.write("image_path,caption,score_by_pipeline\n")
-
-# Process each JSON file
-for json_file in json_files:
-    with open(json_file, "r") as f:
-        for line in f:  # Process file line by line
-            if line.strip():  # Ignore empty lines
-                try:
-                    data = json.loads(line)  # Parse individual JSON object
-                    image_path = f".{data['image_path']}"
-                    caption = data['caption']
-
-                    # Run main.py with arguments
-                    result = subprocess.run(
-                        ["python", "main.py", image_path, caption],
-                        capture_output=True,
-                        text=True
-                    )
-
-                    # Extract the final score from the output
-                    output_lines = result.stdout.splitlines()
-                    final_score = None
-                    for line in output_lines:
-                        if line.startswith("Final Score:"):
-                            final_score = line.split(":")[1].strip()
-                            break
-
-                    # Write to the result file
-                    with open(output_file, "a") as f:
-                        f.write(f"{image_path},{caption},{final_score}\n")
-
-                except json.JSONDecodeError as e:
-                    print(f"Error decoding JSON line in {json_file}: {line}")
-                    print(f"Details: {e}")
+FIELDS = ["image_path", "caption", "score_by_pipeline"]
+
+
+def read_tasks(json_files):
+    """Stream (image_path, caption) pairs from the JSONL input files"""
+    for json_file in json_files:
+        with open(json_file, "r") as f:
+            for line in f:  # Process file line by line
+                if line.strip():  # Ignore empty lines
+                    try:
+                        data = json.loads(line)  # Parse individual JSON object
+                    except json.JSONDecodeError as e:
+                        print(f"Error decoding JSON line in {json_file}: {line}")
+                        print(f"Details: {e}")
+                        continue
+                    yield f".{data['image_path']}", data['caption']
+
+
+def read_checkpoint(output_file, output_format):
+    """Return the (image_path, caption) pairs already present in the output file"""
+    done = set()
+    if not os.path.exists(output_file):
+        return done
+    with open(output_file, "r", newline="") as f:
+        if output_format == "csv":
+            rows = csv.DictReader(f)
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+        for row in rows:
+            if row.get("score_by_pipeline") not in (None, ""):
+                done.add((row["image_path"], row["caption"]))
+    return done
+
+
+class ResultWriter:
+    """Appends one scored row at a time to a CSV or JSONL file"""
+
+    def __init__(self, output_file, output_format, fresh):
+        new_file = fresh or not os.path.exists(output_file)
+        self.output_format = output_format
+        self.f = open(output_file, "w" if new_file else "a", newline="")
+        if output_format == "csv":
+            self.writer = csv.DictWriter(self.f, fieldnames=FIELDS)
+            if new_file:
+                self.writer.writeheader()
+
+    def write(self, image_path, caption, score):
+        row = {"image_path": image_path, "caption": caption, "score_by_pipeline": score}
+        if self.output_format == "csv":
+            self.writer.writerow(row)
+        else:
+            self.f.write(json.dumps(row) + "\n")
+        # Flush every row so an interrupted run keeps everything scored so far
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+_main = None
+_metrics = None
+_cache = None
+_lazy = False
+_shards = None
+
+def _init_worker(use_cache, lazy, shard_dir, metrics_file=None, torch_threads=None):
+    """Import the pipeline once per worker so models load a single time"""
+    global _main, _metrics, _cache, _lazy, _shards
+    torch = sys.modules.get('torch')
+    if torch is not None and torch_threads:
+        # Forked from a parent that loaded torch: give each worker its own, smaller intra-op
+        # pool instead of relying on the parent's thread pool state surviving the fork
+        torch.set_num_threads(torch_threads)
+    import main as _main_module
+    import PIPEmetrics
+    from PIPEcache import VisionCache
+    from PIPEshards import ShardStore
+    if metrics_file:
+        # One file per worker process, see PIPEmetrics.configure
+        PIPEmetrics.configure(metrics_file, per_process=True)
+    _main = _main_module
+    _metrics = PIPEmetrics
+    _cache = VisionCache() if use_cache else None
+    _lazy = lazy
+    _shards = ShardStore(shard_dir) if shard_dir else None
+
+
+def _score(task):
+    image_path, caption = task
+    try:
+        score = _main.main(image_path, caption, cache=_cache, lazy=_lazy, shard_store=_shards)
+        return image_path, caption, score, None
+    except Exception as e:
+        return image_path, caption, None, f"{type(e).__name__}: {e}"
+    finally:
+        # Pool workers exit without running atexit handlers, so export after every pair
+        _metrics.flush()
+
+
+def _score_remote(client, lazy, task):
+    image_path, caption = task
+    try:
+        return image_path, caption, client.score(image_path, caption, lazy=lazy or None), None
+    except Exception as e:
+        return image_path, caption, None, f"{type(e).__name__}: {e}"
+
+
+def run_batch(json_files, output_file, output_format="csv", workers=None, fresh=False, use_cache=True, lazy=False,
+              shard_dir=None, metrics_file=None, service=None, prewarm=False):
+    """Score every image-caption pair, skipping pairs already in output_file
+
+    With service set (an address of a running PIPEservice.py) the pairs are
+    sent to that service from worker threads instead of being scored by local
+    worker processes; use_cache, shard_dir and metrics_file then follow the
+    service's own configuration.
+
+    With prewarm=True the models and templates are loaded once in this
+    process and the workers are forked from it, so they start with
+    everything loaded (shared copy-on-write) instead of each loading it.
+    """
+    done = set() if fresh else read_checkpoint(output_file, output_format)
+    if done:
+        print(f"Resuming: {len(done)} pairs already scored")
+
+    writer = ResultWriter(output_file, output_format, fresh)
+    workers = workers or os.cpu_count()
+    tasks = (task for task in read_tasks(json_files) if task not in done)
+
+    if service:
+        from PIPEservice import ScoringClient
+        executor = ThreadPoolExecutor(max_workers=workers)
+        score = partial(_score_remote, ScoringClient(service), lazy)
+    else:
+        mp_context = None
+        if prewarm and 'fork' in multiprocessing.get_all_start_methods():
+            import main
+            start = time.perf_counter()
+            main.warm_up()
+            print(f"Pipeline loaded in {time.perf_counter() - start:.1f}s, forking workers")
+            # Keep the loaded objects out of the garbage collector's reach so
+            # collections in the workers do not copy the shared pages
+            gc.freeze()
+            mp_context = multiprocessing.get_context('fork')
+        elif prewarm:
+            print("Warning: this platform cannot fork, workers load the pipeline themselves", file=sys.stderr)
+        torch_threads = max((os.cpu_count() or 1) // workers, 1)
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=mp_context, initializer=_init_worker,
+                                       initargs=(use_cache, lazy, shard_dir, metrics_file, torch_threads))
+        score = _score
+
+    scored = 0
+    with executor:
+        # Keep a bounded number of pairs in flight instead of queueing the whole input
+        pending = set()
+        for task in tasks:
+            pending.add(executor.submit(score, task))
+            if len(pending) < 2 * workers:
+                continue
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            scored += _write_results(finished, writer)
+        scored += _write_results(pending, writer)
+
+    writer.close()
+    print(f"Scored {scored} pairs, results in {output_file}")
+
+
+def _write_results(futures, writer):
+    written = 0
+    for future in futures:
+        image_path, caption, score, error = future.result()
+        if error is not None:
+            print(f"Error scoring {image_path}: {error}", file=sys.stderr)
+            continue
+        writer.write(image_path, caption, score)
+        written += 1
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score image-caption pairs from JSONL files with the pipeline")
+    parser.add_argument("inputs", nargs="*", default=json_files, help="JSONL files with image_path and caption")
+    parser.add_argument("--output", default=output_file, help="results file")
+    parser.add_argument("--format", choices=["csv", "jsonl"], default="csv", help="results file format")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument("--fresh", action="store_true", help="ignore existing results instead of resuming")
+    parser.add_argument("--no-cache", action="store_true", help="recompute vision results instead of using the cache")
+    parser.add_argument("--lazy", action="store_true", help="skip stages that cannot score for a caption")
+    parser.add_argument("--shards", default=None, help="read images from shards packed by PIPEshards.py")
+    parser.add_argument("--metrics", default=None,
+                        help="export stage timings and counters per worker, e.g. metrics.jsonl or metrics.prom")
+    parser.add_argument("--service", default=None,
+                        help="score through a running PIPEservice.py, e.g. http://127.0.0.1:8765 or unix:/tmp/scorer.sock")
+    parser.add_argument("--prewarm", action="store_true",
+                        help="load the models once and fork the workers from this process")
+    args = parser.parse_args()
+
+    run_batch(args.inputs, args.output, args.format, args.workers, args.fresh, not args.no_cache, args.lazy,
+              args.shards, args.metrics, args.service, args.prewarm)
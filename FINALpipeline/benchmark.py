@@ -0,0 +1,346 @@
+import os
+import io
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import threading
+import contextlib
+import tracemalloc
+import numpy as np
+import cv2
+
+# Fixed benchmark inputs: evenly spaced picks from the sorted dataset plus synthetic images
+DATASET_DIR = "../tester/indian_temples"
+SYNTHETIC_SIZES = [(640, 480), (1280, 960), (2560, 1920), (4000, 3000)]
+
+# Caption used for check_similarity and the end-to-end run; mentions a label of every stage
+CAPTION = ("A Dravidian temple gopuram painted in saffron and gold, with a lotus and peacock carved above "
+           "the entrance where a person stands next to a car.")
+
+# Metrics compared against the baseline, all of them lower is better
+COMPARED_METRICS = ['p50_ms', 'p95_ms', 'rss_growth_mb', 'py_peak_kb', 'allocated_blocks']
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+
+def dataset_images(count, root=DATASET_DIR):
+    """count images spread evenly over the sorted dataset, the same ones on every run"""
+    paths = []
+    for directory, _, filenames in os.walk(root):
+        for filename in filenames:
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(directory, filename))
+    paths.sort()
+    if not paths or count <= 0:
+        return []
+    step = max(len(paths) // count, 1)
+    return paths[::step][:count]
+
+
+def synthetic_images(output_dir, sizes=SYNTHETIC_SIZES, seed=0):
+    """Deterministic test images: colored blocks, texture and a line of text, one per size"""
+    rng = np.random.default_rng(seed)
+    paths = []
+    for width, height in sizes:
+        blocks = rng.integers(0, 256, size=(8, 8, 3), dtype=np.uint8)
+        image = cv2.resize(blocks, (width, height), interpolation=cv2.INTER_NEAREST)
+        noise = rng.normal(0, 12, size=image.shape)
+        image = np.clip(image + noise, 0, 255).astype(np.uint8)
+        cv2.putText(image, "SRI MEENAKSHI TEMPLE", (width // 20, height // 2), cv2.FONT_HERSHEY_SIMPLEX,
+                    width / 800, (255, 255, 255), max(width // 400, 1))
+        path = os.path.join(output_dir, f"synthetic_{width}x{height}.jpg")
+        cv2.imwrite(path, image)
+        paths.append(path)
+    return paths
+
+
+def _current_rss():
+    # Resident set size in bytes, from /proc on Linux and the process high-water mark elsewhere
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class RSSSampler:
+    """Samples the process RSS in a background thread and keeps the peak"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, _current_rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = _current_rss()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, _current_rss())
+
+
+def _percentile(values, q):
+    return float(np.percentile(values, q)) if values else None
+
+
+def load_stages(caption=CAPTION):
+    """Benchmarked callables by name, each taking one image path
+
+    A stage whose dependencies cannot be imported is reported as unavailable
+    instead of failing the whole run.
+    """
+    stages = {}
+    errors = {}
+
+    def add(name, make):
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                stages[name] = make()
+        except Exception as e:
+            errors[name] = f"{type(e).__name__}: {e}"
+
+    def objects():
+        from PIPEobject_detection import detect_objects, get_detector
+        get_detector()
+        return detect_objects
+
+    def symbols():
+        from PIPEsymbol_detection import detect_symbols, SymbolTemplateBank
+        bank = SymbolTemplateBank("./symbols", cache_dir="./.cache")
+        return lambda path: detect_symbols(path, bank)
+
+    def color():
+        from PIPEcolor import IndianColorDetector
+        return lambda path: IndianColorDetector().run_analysis(path, headless=True)
+
+    def ocr():
+        from PIPEocrAnalysis import ocr_analysis
+        return ocr_analysis
+
+    def caption_match():
+        from main import check_similarity, stage_vocabulary
+        labels = stage_vocabulary('symbols') + stage_vocabulary('color') + ['person', 'car', 'dog', 'temple']
+        # The caption is normalized per call, as main.main does for every pair
+        return lambda path: check_similarity(labels, caption)
+
+    def end_to_end():
+        from main import main
+        return lambda path: main(path, caption)
+
+    add('objects', objects)
+    add('symbols', symbols)
+    add('color', color)
+    add('ocr', ocr)
+    add('check_similarity', caption_match)
+    add('main', end_to_end)
+    return stages, errors
+
+
+def measure_stage(func, image_paths, repeat=1, warmup=1, trace_allocations=True):
+    """Latency, throughput and memory of func over image_paths
+
+    Warm-up calls (model loading, template scaling) are excluded, and so are
+    calls that raise: they are only counted as errors. Memory is the peak RSS
+    growth over the RSS before the stage's first call, since the process also
+    holds every other stage's models. Latency runs happen without tracemalloc;
+    allocations are measured in one extra traced pass, since tracing slows
+    Python allocations down considerably.
+    """
+    latencies = []
+    errors = 0
+    rss_before = _current_rss()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for path in image_paths[:warmup]:
+            try:
+                func(path)
+            except Exception:
+                pass
+
+        with RSSSampler() as rss:
+            start = time.perf_counter()
+            for _ in range(repeat):
+                for path in image_paths:
+                    call_start = time.perf_counter()
+                    try:
+                        func(path)
+                    except Exception:
+                        errors += 1
+                        continue
+                    latencies.append(time.perf_counter() - call_start)
+            total = time.perf_counter() - start
+
+        py_peak = allocated_blocks = None
+        if trace_allocations:
+            tracemalloc.start()
+            before = tracemalloc.take_snapshot()
+            for path in image_paths:
+                try:
+                    func(path)
+                except Exception:
+                    pass
+            after = tracemalloc.take_snapshot()
+            py_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            # Blocks allocated during the pass and still alive at its end (caches, leaks)
+            allocated_blocks = sum(max(stat.count_diff, 0) for stat in after.compare_to(before, 'filename'))
+
+    latencies_ms = [latency * 1000 for latency in latencies]
+    return {
+        'runs': len(latencies),
+        'errors': errors,
+        'p50_ms': _percentile(latencies_ms, 50),
+        'p95_ms': _percentile(latencies_ms, 95),
+        'mean_ms': float(np.mean(latencies_ms)) if latencies_ms else None,
+        'images_per_second': len(latencies) / total if total > 0 else None,
+        'rss_growth_mb': max(rss.peak - rss_before, 0) / (1 << 20),
+        'py_peak_kb': py_peak / 1024 if py_peak is not None else None,
+        'allocated_blocks': allocated_blocks
+    }
+
+
+def run_benchmark(stage_names=None, dataset_count=8, synthetic=True, repeat=1, trace_allocations=True):
+    """Benchmark the selected stages over the dataset subset and synthetic images"""
+    with tempfile.TemporaryDirectory(prefix='pipeline_bench_') as synthetic_dir:
+        inputs = {'dataset': dataset_images(dataset_count)}
+        if synthetic:
+            inputs['synthetic'] = synthetic_images(synthetic_dir)
+
+        stages, unavailable = load_stages()
+        if stage_names:
+            stages = {name: func for name, func in stages.items() if name in stage_names}
+            unavailable = {name: error for name, error in unavailable.items() if name in stage_names}
+
+        results = {}
+        for name, func in stages.items():
+            for input_name, paths in inputs.items():
+                if not paths:
+                    continue
+                key = f"{name}/{input_name}"
+                print(f"Benchmarking {key} ({len(paths)} images x {repeat})")
+                results[key] = measure_stage(func, paths, repeat=repeat, trace_allocations=trace_allocations)
+
+    return {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'repeat': repeat,
+            'selected_stages': stage_names,
+            'images': {input_name: [os.path.basename(path) if input_name == 'synthetic' else path
+                                    for path in paths] for input_name, paths in inputs.items()}
+        },
+        'stages': results,
+        'unavailable': unavailable
+    }
+
+
+def compare(current, baseline, threshold=0.10):
+    """Regressions of current against baseline: metrics that grew by more than threshold, any new errors
+    and baseline stages the current run should have measured but did not"""
+    regressions = []
+    for key, metrics in current['stages'].items():
+        base = baseline.get('stages', {}).get(key)
+        if base is None:
+            continue
+        # A stage that started failing is a regression however fast it fails
+        if metrics['errors'] > base.get('errors', 0):
+            old = base.get('errors', 0)
+            regressions.append({'stage': key, 'metric': 'errors', 'baseline': old, 'current': metrics['errors'],
+                                'change': (metrics['errors'] - old) / old if old else None})
+        for metric in COMPARED_METRICS:
+            new, old = metrics.get(metric), base.get(metric)
+            if new is None or not old:
+                continue
+            change = (new - old) / old
+            if change > threshold:
+                regressions.append({'stage': key, 'metric': metric, 'baseline': old, 'current': new,
+                                    'change': change})
+    # A stage that no longer runs at all (e.g. its import now fails) must not pass silently
+    selected = current['meta'].get('selected_stages')
+    for key in baseline.get('stages', {}):
+        stage, _, input_name = key.partition('/')
+        if selected and stage not in selected or not current['meta']['images'].get(input_name):
+            continue
+        if key not in current['stages']:
+            regressions.append({'stage': key, 'metric': 'missing', 'baseline': None, 'current': None,
+                                'change': None})
+    return regressions
+
+
+def _format(value, width, precision):
+    return f"{value:>{width}.{precision}f}" if value is not None else f"{'-':>{width}}"
+
+
+def print_report(results, baseline=None):
+    print(f"{'stage':<28}{'p50 ms':>10}{'p95 ms':>10}{'img/s':>9}{'+rss MB':>9}{'py KB':>10}{'blocks':>9}")
+    for key, metrics in results['stages'].items():
+        line = (f"{key:<28}{_format(metrics['p50_ms'], 10, 2)}{_format(metrics['p95_ms'], 10, 2)}"
+                f"{_format(metrics['images_per_second'], 9, 2)}{_format(metrics['rss_growth_mb'], 9, 0)}")
+        line += f"{metrics['py_peak_kb']:>10.0f}{metrics['allocated_blocks']:>9}" if metrics['py_peak_kb'] is not None else ""
+        if baseline and key in baseline.get('stages', {}):
+            old = baseline['stages'][key]['p50_ms']
+            if old and metrics['p50_ms'] is not None:
+                line += f"   p50 {100 * (metrics['p50_ms'] - old) / old:+.1f}%"
+        if metrics['errors']:
+            line += f"   ({metrics['errors']} errors)"
+        print(line)
+    for name, error in results['unavailable'].items():
+        print(f"{name:<28}unavailable: {error}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark pipeline stages and compare against a baseline")
+    parser.add_argument("--stages", nargs="*", default=None,
+                        help="objects, symbols, color, ocr, check_similarity and/or main (default: all)")
+    parser.add_argument("--images", type=int, default=8, help="number of dataset images to use")
+    parser.add_argument("--no-synthetic", action="store_true", help="skip the synthetic images")
+    parser.add_argument("--repeat", type=int, default=1, help="timed passes over the images")
+    parser.add_argument("--no-trace", action="store_true", help="skip the tracemalloc allocation pass")
+    parser.add_argument("--output", default="benchmark.json", help="results file")
+    parser.add_argument("--baseline", default=None, help="earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="relative increase of a metric that counts as a regression")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.stages, args.images, not args.no_synthetic, args.repeat, not args.no_trace)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('meta', {}).get('images') != results['meta']['images']:
+            print("Warning: baseline was measured on different images")
+        results['regressions'] = compare(results, baseline, args.threshold)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print_report(results, baseline)
+    print(f"Results written to {args.output}")
+
+    if baseline is not None:
+        for regression in results['regressions']:
+            if regression['metric'] == 'missing':
+                error = results['unavailable'].get(regression['stage'].split('/')[0], 'not run')
+                print(f"REGRESSION {regression['stage']} missing from this run: {error}")
+                continue
+            change = f" ({100 * regression['change']:+.1f}%)" if regression['change'] is not None else ""
+            print(f"REGRESSION {regression['stage']} {regression['metric']}: {regression['baseline']:.1f} -> "
+                  f"{regression['current']:.1f}{change}")
+        sys.exit(1 if results['regressions'] else 0)
@@ -1,25 +1,294 @@
-import spacy
-from PIPEcolor import IndianColorDetector
 # from PIPEgeo import detect_landmarks
-from PIPEobject_detection import detect_objects
-from PIPEocrAnalysis import ocr_analysis
-from PIPEsymbol_detection import detect_symbols
-import sys
+# Stage modules (OpenCV, PyTorch, tesseract, matplotlib) are imported inside the
+# functions that use them, so importing this module or running a single stage
+# only pays for what actually runs
+from PIPEcache import VisionCache
+from PIPEcaption import CaptionAnalyzer
+from PIPEscheduler import StageGraph, StageResult
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import PIPEmetrics
+import argparse
+import logging
+import time
+import threading
+import os
 
+log = logging.getLogger(__name__)
 
-# Load the NLP model
-nlp = spacy.load("en_core_web_sm")
 
-# Function to perform NLP on caption and check for similarities
+# Symbol templates are loaded and scaled once on first use, then reused for every image
+_symbol_bank = None
+_symbol_bank_lock = threading.Lock()
+
+def get_symbol_bank():
+    global _symbol_bank
+    if _symbol_bank is None:
+        with _symbol_bank_lock:
+            if _symbol_bank is None:
+                from PIPEsymbol_detection import SymbolTemplateBank
+                _symbol_bank = SymbolTemplateBank("./symbols", cache_dir="./.cache")
+    return _symbol_bank
+
+# Template matching is spread over a pool of SYMBOL_WORKERS workers when set, processes
+# unless SYMBOL_POOL=thread; the detected symbols are the same as without a pool
+_symbol_matcher = None
+
+def get_symbol_matcher():
+    global _symbol_matcher
+    workers = int(os.environ.get('SYMBOL_WORKERS', 0) or 0)
+    if _symbol_matcher is None and workers > 1:
+        bank = get_symbol_bank()
+        with _symbol_bank_lock:
+            if _symbol_matcher is None:
+                from PIPEsymbol_detection import ParallelSymbolMatcher
+                _symbol_matcher = ParallelSymbolMatcher(bank, workers, os.environ.get('SYMBOL_POOL', 'process'))
+    return _symbol_matcher
+
+# Caption matcher; stage labels are registered as stages report them (unregistered
+# labels fall back to a substring check, so matching gives the same answers either way)
+caption_analyzer = CaptionAnalyzer()
+
+# Bump a stage's version whenever its output changes so cached results are not reused
+STAGE_VERSIONS = {
+    'objects': 2,
+    'symbols': 3,
+    'color': 1,
+    'ocr': 4
+}
+
+def run_stage(cache, image, stage, compute, **params):
+    """Run one image-only stage, going through the vision cache when one is given"""
+    if cache is None:
+        return compute()
+    params['version'] = STAGE_VERSIONS[stage]
+    params['max_side'] = image.max_side
+    return cache.get_or_compute(image.path, stage, params, compute, image.content_hash)
+
+# Function to check whether any detected item is mentioned in the caption
 def check_similarity(detected_items, caption):
-    doc = nlp(caption)
-    for item in detected_items:
-        if item.lower() in doc.text.lower():
-            return True
-    return False
+    if isinstance(caption, str):
+        caption = caption_analyzer.analyze(caption)
+    return caption_analyzer.matches(caption, detected_items)
+
+# Stage functions: each runs one detector on the shared ImageContext and returns what it found
+def detect_stage_objects(image, cache=None):
+    from PIPEobject_detection import get_detector, detector_key
+    detections = run_stage(cache, image, 'objects',
+                           lambda: get_detector().detect([image.bgr])[0], model=detector_key())
+    objects = [obj['object'] for obj in detections]
+    caption_analyzer.add_labels(objects)
+    log.info("Objects detected: %d", len(objects))
+    return objects
+
+def detect_stage_symbols(image, cache=None):
+    from PIPEsymbol_detection import detect_symbols
+    symbol_bank = get_symbol_bank()
+    symbols = run_stage(cache, image, 'symbols',
+                        lambda: detect_symbols(image, symbol_bank, matcher=get_symbol_matcher())[0],
+                        bank=symbol_bank.key)
+    caption_analyzer.add_labels(symbols)
+    log.info("Symbols detected: %d", len(symbols))
+    return symbols
+
+def detect_stage_color(image, cache=None):
+    def analyze_colors():
+        from PIPEcolor import IndianColorDetector
+        detector = IndianColorDetector()
+        detector.run_analysis(image, headless=True)
+        return detector.last_analysis
+    color_analysis = run_stage(cache, image, 'color', analyze_colors)
+    color_detected = list(color_analysis['filtered_colors'].keys())
+    caption_analyzer.add_labels(color_detected)
+    log.info("Color detected: %s", color_detected)
+    return color_detected
+
+def detect_stage_ocr(image, cache=None):
+    from PIPEocrAnalysis import ocr_analysis
+    ocr_result, language, script_score = run_stage(cache, image, 'ocr',
+                                                   lambda: ocr_analysis(image))
+    log.info("OCR result: %r", ocr_result)
+    # OCR text is matched as a single item
+    return [ocr_result] if ocr_result else []
+
+STAGES = {
+    'objects': detect_stage_objects,
+    'symbols': detect_stage_symbols,
+    'color': detect_stage_color,
+    'ocr': detect_stage_ocr
+}
+
+# Rough relative cost of each stage, cheapest first when stages are ordered lazily
+STAGE_COSTS = {
+    'ocr': 1,
+    'color': 2,
+    'objects': 3,
+    'symbols': 4
+}
+
+# Weights for each component
+WEIGHTS = {
+    'objects': 0.30,
+    'symbols': 0.4,
+    'color': 0.20,
+    'ocr': 0.1
+}
+
+def stage_vocabulary(stage):
+    """Every label a stage can report, or None when its output is open-ended"""
+    if stage == 'objects':
+        # Read without loading the model, planning must not pay for stages it then skips
+        from PIPEobject_detection import detector_names
+        return detector_names()
+    if stage == 'symbols':
+        return [name.split('.')[0] for name in get_symbol_bank().symbol_names()]
+    if stage == 'color':
+        from PIPEcolor import IndianColorDetector
+        return list(IndianColorDetector().indian_colors)
+    return None
+
+def plan_stages(caption):
+    """Split stages into those that could score for this caption and those that cannot
+
+    A stage is skipped only when none of the labels it could ever report is
+    mentioned in the caption, so skipping it cannot change the final score.
+    """
+    needed, skipped = [], []
+    for stage in STAGES:
+        vocabulary = stage_vocabulary(stage)
+        if vocabulary is not None:
+            caption_analyzer.add_labels(vocabulary)
+            if not caption_analyzer.matches(caption, vocabulary):
+                skipped.append(stage)
+                continue
+        needed.append(stage)
+    needed.sort(key=lambda stage: STAGE_COSTS[stage])
+    return needed, skipped
+
+# Stages are mostly OpenCV, PyTorch or tesseract work that releases the GIL, so threads can overlap them
+_stage_executor = None
+_stage_executor_lock = threading.Lock()
+
+def get_stage_executor():
+    global _stage_executor
+    with _stage_executor_lock:
+        if _stage_executor is None:
+            _stage_executor = ThreadPoolExecutor(max_workers=len(STAGES), thread_name_prefix='stage')
+        return _stage_executor
+
+def retire_stage_executor(executor):
+    """Stop handing out executor, the next image gets a fresh pool
+
+    Calls already holding it keep using it; its threads exit once their work
+    is done and nothing references the pool any more.
+    """
+    global _stage_executor
+    with _stage_executor_lock:
+        if _stage_executor is executor:
+            _stage_executor = None
+            PIPEmetrics.count('stages.executor_retired')
+
+def _reset_after_fork():
+    # Threads and pool processes do not survive a fork; a forked worker starts its own pools
+    global _stage_executor, _stage_executor_lock, _symbol_matcher, _symbol_bank_lock
+    _stage_executor = None
+    _stage_executor_lock = threading.Lock()
+    _symbol_matcher = None
+    _symbol_bank_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+def warm_up(stages=None):
+    """Import and load everything the given stages (default: all) need before the first image
+
+    Meant for a parent process that then forks its workers, so models and
+    templates are loaded once and shared copy-on-write. This imports torch
+    and loads the YOLO model but runs no inference and starts no pipeline
+    threads, which would not survive the fork; forked workers set their own
+    torch thread count (see automate_script._init_worker). Sharing the model
+    this way relies on torch and the loaded model being fork-safe.
+    """
+    import PIPEimage
+    for stage in stages or STAGES:
+        vocabulary = stage_vocabulary(stage)
+        if vocabulary is not None:
+            caption_analyzer.add_labels(vocabulary)
+        if stage == 'objects':
+            from PIPEobject_detection import get_detector
+            get_detector()
+        if stage == 'ocr':
+            # The OCR engine itself starts worker threads, so only the module is loaded
+            import PIPEocrAnalysis
+
+def run_timed_stage(stage, image, cache=None):
+    with PIPEmetrics.span(f"stage.{stage}"):
+        return STAGES[stage](image, cache)
+
+def run_stages_sequential(stages, image, cache):
+    results = {}
+    for stage in stages:
+        start = time.perf_counter()
+        output = run_timed_stage(stage, image, cache)
+        results[stage] = StageResult(stage, 'ok', output=output, seconds=time.perf_counter() - start)
+    return results
+
+def run_stages_parallel(stages, image, cache, timeouts=None, executor=None):
+    """Run independent stages concurrently; failed or timed out stages just score 0"""
+    timeouts = timeouts or {}
+    graph = StageGraph()
+    for stage in stages:
+        graph.add(stage, partial(run_timed_stage, stage, image, cache), timeout=timeouts.get(stage))
+    shared = executor is None
+    executor = executor or get_stage_executor()
+    results = graph.run(executor)
+    if graph.abandoned and shared:
+        # Abandoned stages hold on to workers of the shared pool until they finish;
+        # later images get a fresh pool instead of queueing (and timing out) behind them
+        retire_stage_executor(executor)
+    for stage, result in results.items():
+        if result.status != 'ok':
+            log.warning("Stage %s %s: %s", stage, result.status, result.error)
+            PIPEmetrics.count(f"stage.{stage}.{result.status}")
+    return results
 
 # Main function to calculate the score
-def main(image_path, caption):
+def main(image_path, caption, cache=None, lazy=False, return_details=False,
+         parallel=False, timeouts=None, executor=None, max_side=None, shard_store=None):
+    """Score how well the caption matches the Indian elements found in the image
+
+    With lazy=True the caption is analyzed first and stages that cannot add
+    to the score are skipped (the final score is the same as in eager mode).
+    With parallel=True the stages run concurrently (on executor, or a shared
+    thread pool), each limited by its entry in timeouts (seconds by stage
+    name); a stage that fails or times out scores 0. With return_details=True
+    a (final_score, details) tuple is returned, where details holds the per
+    stage scores, the skipped stages and each stage's result.
+
+    The image is decoded at most once and shared by all stages; max_side caps
+    its longest side (see ImageContext), which makes large photos cheaper.
+    Images present in shard_store (a PIPEshards.ShardStore) are read from its
+    pre-decoded shards instead of the file.
+
+    Progress goes to the module logger; with PIPEmetrics enabled the whole
+    call, every stage and their sub-steps are timed.
+    """
+    with PIPEmetrics.span('main'):
+        return _main(image_path, caption, cache, lazy, return_details, parallel, timeouts, executor,
+                     max_side, shard_store)
+
+def _main(image_path, caption, cache, lazy, return_details, parallel, timeouts, executor, max_side, shard_store):
+    from PIPEimage import ImageContext
+
+    # Normalize the caption once for all stages
+    caption = caption_analyzer.analyze(caption)
+
+    # Decoded on first use (or read from the shards), then shared by every stage
+    if shard_store is not None and image_path in shard_store:
+        image = shard_store.context(image_path)
+    else:
+        image = ImageContext(image_path, max_side)
+
     # Initialize scores for each component
     scores = {
         # 'landmarks': 0,
@@ -35,53 +304,50 @@ def main(image_path, caption):
     # if len(landmarks) > 0 and check_similarity(landmarks, caption):
     #     scores['landmarks'] = 1
 
-    # Detect objects
-    objects = detect_objects(image_path)
-    print(f"Objects detected: {len(objects)}")
-    if len(objects) > 0 and check_similarity(objects, caption):
-        scores['objects'] = 1
-
-    # Detect symbols
-    symbols,result_info = detect_symbols(image_path,"./symbols")
-    print(f"Symbols detected: {len(symbols)}")
-    if len(symbols) > 0 and check_similarity(symbols, caption):
-        scores['symbols'] = 1
-
-    # Perform color analysis
-    detector = IndianColorDetector()
-    image_path = 'test1.jpg'  # Replace with your image path
-    detected_colors = detector.run_analysis(image_path)
-    color_detected = detected_colors
-    print(f"Color detected: {color_detected}")
-    if color_detected and check_similarity(color_detected, caption):
-        scores['color'] = 1
-
-    # Perform OCR analysis
-    ocr_result, language, script_score = ocr_analysis(image_path)
-    print(f"OCR result: {ocr_result}")
-    if ocr_result and check_similarity([ocr_result], caption):
-        scores['ocr'] = 1
-
-    # Weights for each component
-    weights = {
-        'objects': 0.30,
-        'symbols': 0.4,
-        'color': 0.20,
-        'ocr': 0.1
-    }
+    if lazy:
+        stages, skipped = plan_stages(caption)
+        log.info("Stages skipped: %s", skipped)
+        PIPEmetrics.count('stages.skipped', len(skipped))
+    else:
+        stages, skipped = list(STAGES), []
+
+    # Run the detectors
+    if parallel:
+        stage_results = run_stages_parallel(stages, image, cache, timeouts, executor)
+    else:
+        stage_results = run_stages_sequential(stages, image, cache)
+
+    # Check their findings against the caption
+    for stage, result in stage_results.items():
+        detected = result.output
+        if result.status == 'ok' and len(detected) > 0 and check_similarity(detected, caption):
+            scores[stage] = 1
 
     # Calculate final weighted score
-    final_score = sum(scores[component] * weights[component] for component in scores) * 10
+    final_score = sum(scores[component] * WEIGHTS[component] for component in scores) * 10
 
-    print(f"Final Score: {final_score}")
+    log.info("Final Score: %s", final_score)
+    if return_details:
+        return final_score, {
+            'scores': scores,
+            'skipped': skipped,
+            'stages': {stage: result.as_dict() for stage, result in stage_results.items()}
+        }
     return final_score
 
 
 if __name__ == "__main__":
-    if len(sys.argv) >= 3:
-        image_path = sys.argv[1]
-        caption = " ".join(sys.argv[2:])  # Combine all remaining arguments as the caption
-        print("hi")
+    parser = argparse.ArgumentParser(description="Score how well a caption matches the Indian elements in an image")
+    parser.add_argument("image_path", nargs="?", help="image to score (default: a sample image)")
+    parser.add_argument("caption", nargs="*", help="caption words (default: a sample caption)")
+    parser.add_argument("--lazy", action="store_true", help="skip stages that cannot score for the caption")
+    parser.add_argument("--no-cache", action="store_true", help="recompute vision results instead of using the cache")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if args.image_path and args.caption:
+        image_path = args.image_path
+        caption = " ".join(args.caption)  # Combine all remaining arguments as the caption
     else:
         # Default values if no arguments are provided
         image_path = "./Me/Sabarimala_Ayyappa_Temple/Image_67.jpg"
@@ -105,4 +371,4 @@ if __name__ == "__main__":
             "The temple's overall design and features reflect a profound connection to Indic heritage and spiritual traditions. "
             "The presence of the gopuram, mandapas, intricate carvings, and likely deities all speak to the deep reverence for the divine and the complex cultural and philosophical framework of Hinduism."
         )
-    main(image_path, caption)
\ No newline at end of file
+    main(image_path, caption, cache=None if args.no_cache else VisionCache(), lazy=args.lazy)
\ No newline at end of file